@@ -0,0 +1,569 @@
+# global import statements
+import io
+import os
+import gc
+import sys
+import json
+import time
+import datetime
+import pandas as pd
+import numpy as np
+
+import lb_edm_util
+
+# Field names used by the benchmark when calling calculate_earned_duration
+EDM_FIELD_NAMES = ['task_id', 'target_start_date', 'target_end_date', 'late_start_date', 'late_end_date',
+                   'early_start_date', 'early_end_date', 'late_start_date', 'late_end_date',
+                   'act_start_date', 'act_end_date']
+
+TASK_FIELDS = ['task_id', 'proj_id', 'wbs_id', 'clndr_id', 'task_type', 'duration_type', 'complete_pct_type', 'status_code',
+               'task_code', 'task_name', 'target_drtn_hr_cnt', 'remain_drtn_hr_cnt',
+               'act_start_date', 'act_end_date', 'early_start_date', 'early_end_date', 'late_start_date', 'late_end_date',
+               'target_start_date', 'target_end_date', 'restart_date', 'reend_date']
+
+# P6 separates calendar data nodes with the DEL character
+_CLNDR_SEP = u'\x7f\x7f'
+
+def _format_dates(values):
+    ''' Formats a datetime64 array as XER date strings (blank for NaT).'''
+    text = np.datetime_as_string(values.astype('datetime64[m]'), unit = 'm')
+    text = np.char.replace(text, 'T', ' ')
+    return np.where(pd.isnull(values), '', text)
+
+def _make_calendar_data(lst_work_days, lst_holidays):
+    ''' Builds a P6 clndr_data value with 08:00-12:00 and 13:00-17:00 working periods on the given days (1 = Sunday) and holiday exceptions.'''
+    lst_days = []
+    for day in range(1, 8):
+        if day in lst_work_days:
+            lst_days.append(u'(0||%d()(%s(0||0(s|08:00|f|12:00)())%s(0||1(s|13:00|f|17:00)())))' % (day, _CLNDR_SEP, _CLNDR_SEP))
+        else:
+            lst_days.append(u'(0||%d()())' % day)
+    lst_exceptions = [u'(0||%d(d|%d)())' % (i, (x - datetime.date(1899, 12, 30)).days) for i, x in enumerate(lst_holidays)]
+    return (u'(0||CalendarData()(%s(0||DaysOfWeek()(%s%s))%s(0||Exceptions()(%s%s))))'
+            % (_CLNDR_SEP, _CLNDR_SEP, _CLNDR_SEP.join(lst_days), _CLNDR_SEP, _CLNDR_SEP if lst_exceptions else u'', _CLNDR_SEP.join(lst_exceptions)))
+
+def _build_tree(num_levels, fan_out, first_id, root_id):
+    ''' Builds a balanced tree under root_id as lists of (id, parent id, short name) and returns it with its leaf ids.'''
+    lst_nodes = []
+    lst_level = [(root_id, '')]
+    next_id = first_id
+    for level in range(num_levels):
+        lst_next_level = []
+        for parent_id, parent_name in lst_level:
+            for i in range(fan_out):
+                name = '%s%02d' % (parent_name, i + 1)
+                lst_nodes.append((next_id, parent_id, name))
+                lst_next_level.append((next_id, name))
+                next_id += 1
+        lst_level = lst_next_level
+    return lst_nodes, [x[0] for x in lst_level]
+
+def generate_schedule(num_activities=1000, wbs_depth=3, wbs_fan_out=5, code_depth=2, code_fan_out=8,
+                      span_days=3 * 365, share_complete=0.4, share_active=0.1, seed=0,
+                      start_date='2015-01-05 08:00', num_holidays=10):
+    '''
+    Generates a synthetic schedule as a dictionary of XER tables (PROJECT, CALENDAR, PROJWBS, TASK, ACTVTYPE, ACTVCODE, TASKACTV) and its data date.
+    Activities are spread over span_days and get Complete, Active and Not Started statuses at the data date by the given shares.
+    '''
+    rs = np.random.RandomState(seed)
+    n = num_activities
+    project_start = np.datetime64(pd.Timestamp(start_date).to_datetime64(), 'm')
+    span = np.timedelta64(int(span_days) * 24 * 60, 'm')
+    data_date = project_start + np.timedelta64(int(span_days * (share_complete + share_active / 2.0)) * 24 * 60, 'm')
+    data_date = data_date.astype('datetime64[D]').astype('datetime64[m]')
+
+    # Calendars: 5 day week with holidays and 7 day week
+    lst_holidays = sorted(set(pd.Timestamp(project_start).date() + datetime.timedelta(days = int(x)) for x in rs.randint(0, span_days, num_holidays)))
+    dict_tables = {}
+    dict_tables['CALENDAR'] = pd.DataFrame({'clndr_id': ['1', '2'], 'default_flag': ['Y', 'N'], 'clndr_name': ['5 Day Week', '7 Day Week'],
+                                            'day_hr_cnt': ['8', '8'], 'week_hr_cnt': ['40', '56'],
+                                            'clndr_data': [_make_calendar_data([2, 3, 4, 5, 6], lst_holidays), _make_calendar_data(range(1, 8), [])]},
+                                           columns = ['clndr_id', 'default_flag', 'clndr_name', 'day_hr_cnt', 'week_hr_cnt', 'clndr_data'])
+    dict_tables['PROJECT'] = pd.DataFrame({'proj_id': ['1'], 'proj_short_name': ['SYN'], 'clndr_id': ['1'],
+                                           'plan_start_date': _format_dates(np.array([project_start])),
+                                           'last_recalc_date': _format_dates(np.array([data_date]))},
+                                          columns = ['proj_id', 'proj_short_name', 'clndr_id', 'plan_start_date', 'last_recalc_date'])
+
+    # WBS tree under the project node
+    lst_wbs, lst_leaf_wbs_ids = _build_tree(wbs_depth, wbs_fan_out, 101, 100)
+    dict_tables['PROJWBS'] = pd.DataFrame([('100', '1', 'Y', 'SYN', '')] + [(str(i), '1', 'N', 'W' + name, str(p)) for i, p, name in lst_wbs],
+                                          columns = ['wbs_id', 'proj_id', 'proj_node_flag', 'wbs_short_name', 'parent_wbs_id'])
+
+    # Activity code hierarchy (CSI)
+    lst_codes, lst_leaf_code_ids = _build_tree(code_depth, code_fan_out, 1001, None)
+    dict_tables['ACTVTYPE'] = pd.DataFrame({'actv_code_type_id': ['1'], 'actv_code_type': ['CSI']}, columns = ['actv_code_type_id', 'actv_code_type'])
+    dict_tables['ACTVCODE'] = pd.DataFrame([(str(i), '1', 'Code ' + name, name, '' if p is None else str(p)) for i, p, name in lst_codes],
+                                           columns = ['actv_code_id', 'actv_code_type_id', 'actv_code_name', 'short_name', 'parent_actv_code_id'])
+
+    # Activities: status first, then dates consistent with the status at the data date
+    task_ids = np.arange(10000, 10000 + n)
+    status = rs.choice(np.array(['TK_Complete', 'TK_Active', 'TK_NotStart']), n, p = [share_complete, share_active, 1.0 - share_complete - share_active])
+    duration = np.timedelta64(24 * 60, 'm') * rs.randint(0, 60, n)
+    before = (data_date - project_start).astype(np.int64)
+    after = (project_start + span - data_date).astype(np.int64)
+    offset = np.where(status == 'TK_Complete', (rs.random_sample(n) * (before - duration.astype(np.int64)).clip(0)).astype(np.int64),
+             np.where(status == 'TK_Active', before - (rs.random_sample(n) * duration.astype(np.int64)).astype(np.int64) - 1,
+                      before + (rs.random_sample(n) * after).astype(np.int64)))
+    start = (project_start + offset.astype('timedelta64[m]')).astype('datetime64[D]').astype('datetime64[m]') + np.timedelta64(8 * 60, 'm')
+    finish = start + duration
+    finish = np.where((status == 'TK_Complete') & (finish > data_date), data_date, finish)
+    total_float = np.timedelta64(24 * 60, 'm') * rs.randint(0, 30, n)
+    slip = np.timedelta64(24 * 60, 'm') * rs.randint(-10, 10, n)
+    nat = np.full(n, np.datetime64('NaT'), dtype = 'datetime64[m]')
+
+    # Baseline (target) dates slip from the actual/current dates
+    target_start = start - slip
+    target_end = finish - slip
+    not_started = status == 'TK_NotStart'
+    active = status == 'TK_Active'
+    early_start = np.where(not_started, start, np.where(active, data_date, nat))
+    early_end = np.where(status == 'TK_Complete', nat, np.maximum(finish, data_date))
+    dict_tasks = {'task_id': task_ids.astype(str), 'proj_id': np.repeat('1', n),
+                  'wbs_id': np.array(lst_leaf_wbs_ids)[rs.randint(0, len(lst_leaf_wbs_ids), n)].astype(str),
+                  'clndr_id': np.where(rs.random_sample(n) < 0.8, '1', '2'), 'task_type': np.repeat('TT_Task', n),
+                  'duration_type': np.repeat('DT_FixedDUR2', n), 'complete_pct_type': np.repeat('CP_Drtn', n), 'status_code': status,
+                  'task_code': np.char.add('A', task_ids.astype(str)), 'task_name': np.char.add('Activity ', task_ids.astype(str)),
+                  'target_drtn_hr_cnt': (duration.astype(np.int64) // 60 * 8 // 24).astype(str),
+                  'remain_drtn_hr_cnt': np.where(status == 'TK_Complete', 0, duration.astype(np.int64) // 60 * 8 // 24).astype(str),
+                  'act_start_date': _format_dates(np.where(not_started, nat, start)),
+                  'act_end_date': _format_dates(np.where(status == 'TK_Complete', finish, nat)),
+                  'early_start_date': _format_dates(np.where(status == 'TK_Complete', start, early_start)),
+                  'early_end_date': _format_dates(np.where(status == 'TK_Complete', finish, early_end)),
+                  'late_start_date': _format_dates(np.where(status == 'TK_Complete', start, early_start + total_float)),
+                  'late_end_date': _format_dates(np.where(status == 'TK_Complete', finish, early_end + total_float)),
+                  'target_start_date': _format_dates(target_start), 'target_end_date': _format_dates(target_end),
+                  'restart_date': _format_dates(np.where(status == 'TK_Complete', nat, early_start)),
+                  'reend_date': _format_dates(np.where(status == 'TK_Complete', nat, early_end))}
+    dict_tables['TASK'] = pd.DataFrame(dict_tasks, columns = TASK_FIELDS)
+
+    dict_tables['TASKACTV'] = pd.DataFrame({'task_id': task_ids.astype(str), 'actv_code_type_id': np.repeat('1', n),
+                                            'actv_code_id': np.array(lst_leaf_code_ids)[rs.randint(0, len(lst_leaf_code_ids), n)].astype(str),
+                                            'proj_id': np.repeat('1', n)},
+                                           columns = ['task_id', 'actv_code_type_id', 'actv_code_id', 'proj_id'])
+
+    return dict_tables, pd.Timestamp(data_date)
+
+def make_baseline(dict_tables):
+    ''' Returns the baseline version of a generated schedule: all activities not started on their target dates, with the project start as data date.'''
+    dict_baseline = dict((k, v.copy()) for k, v in dict_tables.items())
+    df_tasks = dict_baseline['TASK']
+    df_tasks['status_code'] = 'TK_NotStart'
+    df_tasks['remain_drtn_hr_cnt'] = df_tasks['target_drtn_hr_cnt']
+    for field_name in ['act_start_date', 'act_end_date']:
+        df_tasks[field_name] = ''
+    for field_name in ['early_start_date', 'late_start_date', 'restart_date']:
+        df_tasks[field_name] = df_tasks['target_start_date']
+    for field_name in ['early_end_date', 'late_end_date', 'reend_date']:
+        df_tasks[field_name] = df_tasks['target_end_date']
+    dict_baseline['PROJECT']['last_recalc_date'] = dict_baseline['PROJECT']['plan_start_date']
+    return dict_baseline
+
+def make_update(dict_tables, share_removed=0.02, share_added=0.02, seed=0):
+    ''' Returns an update version of a generated schedule with a share of activities removed and new activities added (copied from existing ones with new ids).'''
+    rs = np.random.RandomState(seed)
+    dict_update = dict((k, v.copy()) for k, v in dict_tables.items())
+    df_tasks = dict_update['TASK']
+    n = len(df_tasks)
+
+    # Sampling without replacement so that every added activity gets its own id
+    df_added = df_tasks.iloc[rs.choice(n, int(n * share_added), replace = False)].copy()
+    dict_added_ids = dict(zip(df_added['task_id'], (np.arange(len(df_added)) + 10000 + 2 * n).astype(str)))
+    df_added['task_id'] = df_added['task_id'].map(dict_added_ids)
+    df_added['target_start_date'] = ''
+    df_added['target_end_date'] = ''
+    df_tasks = df_tasks[rs.random_sample(n) >= share_removed]
+    dict_update['TASK'] = pd.concat([df_tasks, df_added], ignore_index = True)
+
+    # Added activities keep the activity codes of the activities they were copied from
+    df_taskactv = dict_update['TASKACTV']
+    df_taskactv_added = df_taskactv[df_taskactv['task_id'].isin(dict_added_ids)].copy()
+    df_taskactv_added['task_id'] = df_taskactv_added['task_id'].map(dict_added_ids)
+    dict_update['TASKACTV'] = pd.concat([df_taskactv[df_taskactv['task_id'].isin(df_tasks['task_id'])], df_taskactv_added], ignore_index = True)
+    return dict_update
+
+def write_xer(file_name, dict_tables):
+    ''' Writes a dictionary of entity names and data frames as a Primavera P6 XER file.'''
+    with io.open(file_name, 'w', encoding = 'ISO-8859-1', newline = '\r\n') as f:
+        f.write(u'ERMHDR\t8.0\t%s\tProject\tadmin\tbenchmark\tdbxDatabaseNoName\tProject Management\tUSD\n' % datetime.date.today().isoformat())
+        for tbl_name in ['CALENDAR', 'PROJECT', 'PROJWBS', 'ACTVTYPE', 'ACTVCODE', 'TASK', 'TASKACTV']:
+            df = dict_tables[tbl_name]
+            f.write(u'%T\t' + tbl_name + u'\n')
+            f.write(u'%F\t' + u'\t'.join(df.columns) + u'\n')
+            for row in df.itertuples(index = False):
+                f.write(u'%R\t' + u'\t'.join(u'%s' % x for x in row) + u'\n')
+        f.write(u'%E\n')
+
+def generate_baseline_update_xer(baseline_file_name, update_file_name, share_removed=0.02, share_added=0.02, **kwargs):
+    ''' Generates a matching pair of baseline and update XER files; kwargs are passed to generate_schedule.'''
+    dict_tables, data_date = generate_schedule(**kwargs)
+    write_xer(baseline_file_name, make_baseline(dict_tables))
+    write_xer(update_file_name, make_update(dict_tables, share_removed, share_added, kwargs.get('seed', 0)))
+    return data_date
+
+def measure(func, *args, **kwargs):
+    '''
+    Calls a function and returns its result, wall time (seconds) and peak memory (bytes).
+    Peak memory is the tracemalloc peak where available, else the peak resident set size of the call over the resident set size at its start
+    (Linux, see lb_edm_util._PeakMemory; this resets the peak resident set size of the benchmark process), else the growth of the process maximum resident set size.
+    '''
+    gc.collect()
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+
+    if tracemalloc is not None:
+        tracemalloc.start()
+        t = time.time()
+        result = func(*args, **kwargs)
+        seconds = time.time() - t
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    else:
+        peak_memory = lb_edm_util._PeakMemory(reset_peak_rss = True)
+        try:
+            t = time.time()
+            result = func(*args, **kwargs)
+            seconds = time.time() - t
+        finally:
+            peak_mb, growth_mb, scope = peak_memory.stop()
+        peak = growth_mb * 1024 ** 2 if growth_mb is not None else np.nan
+    return result, seconds, peak
+
+def get_benchmark_wbs_paths(df_xer):
+    ''' Returns WBS inclusions (the first two top level nodes) and exclusions (the first node under them) to benchmark WBS filtering with.'''
+    df_nodes = lb_edm_util.build_wbs_index(df_xer).nodes.sort_values('pre_order')
+    lst_wbs_inclusions = df_nodes[df_nodes['depth'] == 1]['path'].iloc[:2].tolist()
+    lst_wbs_exclusions = df_nodes[df_nodes['depth'] == 2]['path'].iloc[:1].tolist()
+    return lst_wbs_inclusions, lst_wbs_exclusions
+
+def run_benchmark(lst_num_activities, output_file, work_dir='.', label='', **kwargs):
+    '''
+    Times and records peak memory of read_xer, time_phase_monthly, calendar-aware time_phase (time_phase_working), get_tasks_by_wbs_paths, get_task_activity_code_assignments and calculate_earned_duration
+    on generated baseline/update pairs of each size. One json record per stage is appended to output_file; kwargs are passed to generate_schedule.
+    '''
+    lst_records = []
+    for num_activities in lst_num_activities:
+        baseline_file_name = os.path.join(work_dir, 'benchmark_baseline_%d.xer' % num_activities)
+        update_file_name = os.path.join(work_dir, 'benchmark_update_%d.xer' % num_activities)
+        if not (os.path.exists(baseline_file_name) and os.path.exists(update_file_name)):
+            generate_baseline_update_xer(baseline_file_name, update_file_name, num_activities = num_activities, **kwargs)
+
+        dict_stages = {}
+        (df_update_xer, update_data_date), seconds, peak = measure(lb_edm_util.read_xer, update_file_name)
+        dict_stages['read_xer'] = (seconds, peak)
+
+        df_tasks = df_update_xer['TASK']
+        dict_stages['time_phase_monthly'] = measure(lb_edm_util.time_phase_monthly, df_tasks.copy(), 'task_id', 'early_start_date', 'early_end_date')[1:]
+        dict_stages['time_phase_working'] = measure(lambda: lb_edm_util.time_phase(df_tasks.copy(), 'task_id', 'early_start_date', 'early_end_date', 'M',
+                                                                   lb_edm_util.WorkingCalendars(df_update_xer['CALENDAR'])))[1:]
+
+        lst_wbs_inclusions, lst_wbs_exclusions = get_benchmark_wbs_paths(df_update_xer)
+        dict_stages['get_tasks_by_wbs_paths'] = measure(lb_edm_util.get_tasks_by_wbs_paths, lst_wbs_inclusions, lst_wbs_exclusions, df_update_xer)[1:]
+        dict_stages['get_task_activity_code_assignments'] = measure(lb_edm_util.get_task_activity_code_assignments, df_update_xer, 'CSI')[1:]
+
+        def end_to_end():
+            df_baseline_xer, baseline_data_date = lb_edm_util.read_xer(baseline_file_name)
+            df_update_xer, update_data_date = lb_edm_util.read_xer(update_file_name)
+            return lb_edm_util.calculate_earned_duration(df_baseline_xer['TASK'], df_update_xer['TASK'], *(EDM_FIELD_NAMES + [True, update_data_date]))
+        dict_stages['calculate_earned_duration'] = measure(end_to_end)[1:]
+
+        for stage, (seconds, peak) in sorted(dict_stages.items()):
+            lst_records.append({'label': label, 'timestamp': datetime.datetime.now().isoformat(), 'num_activities': num_activities,
+                                'stage': stage, 'seconds': seconds, 'peak_mb': peak / 1024.0 ** 2,
+                                'python': sys.version.split()[0], 'pandas': pd.__version__, 'numpy': np.__version__})
+
+    with open(output_file, 'a') as f:
+        for record in lst_records:
+            f.write(json.dumps(record) + '\n')
+    return pd.DataFrame(lst_records)
+
+def load_benchmark(output_file):
+    ''' Loads the records of a benchmark output file into a data frame.'''
+    with open(output_file, 'r') as f:
+        return pd.DataFrame([json.loads(x) for x in f if x.strip()])
+
+def compare_benchmark(output_file, label_1, label_2):
+    ''' Compares the latest records of two labelled runs per stage and size (ratio > 1 means label_2 is faster or smaller).'''
+    df = load_benchmark(output_file).sort_values('timestamp').drop_duplicates(['label', 'num_activities', 'stage'], keep = 'last')
+    df = df.set_index(['num_activities', 'stage'])
+    df_1 = df[df['label'] == label_1][['seconds', 'peak_mb']]
+    df_2 = df[df['label'] == label_2][['seconds', 'peak_mb']]
+    df_compare = df_1.join(df_2, lsuffix = '_' + label_1, rsuffix = '_' + label_2, how = 'inner')
+    df_compare['speedup'] = df_compare['seconds_' + label_1] / df_compare['seconds_' + label_2]
+    # Stages without measurable memory have no ratio
+    df_compare['memory_ratio'] = df_compare['peak_mb_' + label_1] / df_compare['peak_mb_' + label_2].replace(0, np.nan)
+    return df_compare
+
+def reference_time_phase_monthly(df, id_field_name, start_field_name, finish_field_name):
+    ''' Row by row monthly time-phasing used as the reference for output-equivalence checks of faster engines.'''
+    from dateutil.relativedelta import relativedelta
+
+    df = df.copy()
+    df.loc[:,start_field_name] = pd.to_datetime(df.loc[:,start_field_name])
+    df.loc[:,finish_field_name] = pd.to_datetime(df.loc[:,finish_field_name])
+
+    lstTimePhased = []
+    for index, row in df.iterrows():
+        if pd.isnull(row[start_field_name]) or pd.isnull(row[finish_field_name]):
+            continue
+        ASD = row[start_field_name]
+        AFD = row[finish_field_name]
+        ISD = datetime.datetime(year = ASD.year, month = ASD.month, day = 1)
+        FinishPointer = datetime.datetime(year = AFD.year, month = AFD.month, day = 1) + relativedelta(months = 1)
+        while True:
+            IFD = ISD + relativedelta(months = 1)
+            lstTimePhased.append([index, str(ISD.year) + "-" + str(ISD.month).rjust(2, '0'), (min(IFD, AFD) - max(ISD, ASD)).total_seconds()/(3600 * 24)])
+            ISD = IFD
+            if ISD >= FinishPointer: break
+
+    dfTimePhased = pd.DataFrame.from_records(columns = [id_field_name, 'interval', 'duration'], data = lstTimePhased)
+    return pd.concat([df, dfTimePhased.pivot(index = id_field_name, columns = 'interval', values = 'duration')], axis = 1, join = 'inner')
+
+def reference_get_tasks_by_wbs_paths(lst_wbs_inclusions, lst_wbs_exclusions, df_xer):
+    ''' WBS filtering with find_children, used as the reference for output-equivalence checks of the hierarchy index.'''
+    df_wbs = df_xer['PROJWBS']
+    lst_wbs_path = []
+    for proj in df_wbs[df_wbs['proj_node_flag'] == 'Y']['wbs_id']:
+        lst_wbs_path_project = []
+        lb_edm_util.get_hierarchical_paths(lst_wbs_path_project, proj, '', df_wbs, 'parent_wbs_id', 'wbs_id', 'wbs_short_name')
+        lst_wbs_path.extend(lst_wbs_path_project)
+    dict_paths = dict((x['id'], x['path'][1:]) for x in lst_wbs_path)
+
+    def get_all(lst_paths):
+        lst_ids = [wbs_id for wbs_id, path in dict_paths.items() if path in lst_paths]
+        for wbs_id in list(lst_ids):
+            lb_edm_util.find_children(lst_ids, wbs_id, df_wbs, 'parent_wbs_id', 'wbs_id')
+        return set(lst_ids)
+
+    df_tasks = df_xer['TASK']
+    return df_tasks[df_tasks['wbs_id'].isin(get_all(lst_wbs_inclusions) - get_all(lst_wbs_exclusions))]
+
+def reference_get_task_activity_code_assignments(df_xer, activity_code_type_name):
+    ''' Activity code paths with get_hierarchical_paths, used as the reference for output-equivalence checks of the hierarchy index.'''
+    # Reading Activity Code Types
+    df_activity_code_types = df_xer['ACTVTYPE'][['actv_code_type_id', 'actv_code_type']]
+    act_code_type_id = df_activity_code_types[df_activity_code_types['actv_code_type'] == activity_code_type_name]['actv_code_type_id'].values[0]
+
+    # Reading Activity Codes
+    df_activity_codes = df_xer['ACTVCODE'][df_xer['ACTVCODE']['actv_code_type_id'] == act_code_type_id][['actv_code_id', 'actv_code_name', 'short_name', 'parent_actv_code_id']]
+    lst_activity_code_ids = df_activity_codes[df_activity_codes['parent_actv_code_id'] == '']['actv_code_id']
+    df_paths = pd.DataFrame()
+
+    # Adding Activity Code path in hierarchy
+    for act_code_id in lst_activity_code_ids:
+        lst_activity_code_path = []
+        lb_edm_util.get_hierarchical_paths(lst_activity_code_path, act_code_id, df_activity_codes[df_activity_codes['actv_code_id'] == act_code_id]['short_name'].values[0],
+                                           df_activity_codes, 'parent_actv_code_id', 'actv_code_id', 'short_name')
+        df_paths = pd.concat([df_paths, pd.DataFrame(lst_activity_code_path)])
+
+    # Merging if there are hierarchies
+    if df_paths.shape[0] > 0:
+        df_activity_codes = df_activity_codes.merge(df_paths, left_on = 'actv_code_id', right_on = 'id', how = 'left')
+
+    # Setting parent level paths
+    df_activity_codes.loc[df_activity_codes['parent_actv_code_id'] == '', 'path'] = df_activity_codes.loc[df_activity_codes['parent_actv_code_id'] == '', 'short_name']
+
+    # Deleting extra keys
+    del df_activity_codes['parent_actv_code_id']
+    if 'id' in df_activity_codes.columns:
+        del df_activity_codes['id']
+
+    # Reading Activity Code Assignments to activities
+    df_activity_code_assignments = df_xer['TASKACTV'][df_xer['TASKACTV']['actv_code_type_id'] == act_code_type_id][['task_id', 'actv_code_id']]
+    return df_activity_code_assignments.merge(df_activity_codes, how = 'left', left_on = 'actv_code_id', right_on = 'actv_code_id')
+
+def reference_polarize_update_schedule(df, data_date, early_start_field_name, early_finish_field_name, late_start_field_name, late_finish_field_name,
+                                       actual_start_field_name, actual_finish_field_name):
+    ''' Row-mask polarizing of the original implementation, used by reference_calculate_earned_duration.'''
+    df_update_actual = df[df['status_code'] != 'TK_NotStart'].copy()
+    df_update_actual.loc[:, 'act_start_date_adjusted'] = pd.to_datetime(df_update_actual.loc[:, actual_start_field_name])
+    if df_update_actual.loc[df_update_actual['status_code'] == 'TK_Active'].shape[0] != 0:
+        df_update_actual.loc[df_update_actual['status_code'] == 'TK_Active', 'act_end_date_adjusted'] = data_date
+    if df_update_actual.loc[df_update_actual['status_code'] == 'TK_Complete'].shape[0] != 0:
+        df_update_actual.loc[df_update_actual['status_code'] == 'TK_Complete', 'act_end_date_adjusted'] = pd.to_datetime(df_update_actual.loc[df_update_actual['status_code'] == 'TK_Complete', actual_finish_field_name])
+
+    df_update_plan = df[df['status_code'] != 'TK_Complete'].copy()
+    df_update_plan.loc[:, 'early_start_date_adjusted'] = pd.to_datetime(df_update_plan.loc[:, early_start_field_name])
+    df_update_plan.loc[:, 'early_end_date_adjusted'] = pd.to_datetime(df_update_plan.loc[:, early_finish_field_name])
+    df_update_plan.loc[:, 'late_start_date_adjusted'] = pd.to_datetime(df_update_plan.loc[:, late_start_field_name])
+    df_update_plan.loc[:, 'late_end_date_adjusted'] = pd.to_datetime(df_update_plan.loc[:, late_finish_field_name])
+    return df_update_plan, df_update_actual
+
+def reference_calculate_earned_duration(df_baseline_tasks, df_update_tasks,
+                                        id_field_name, baseline_early_start_field_name, baseline_early_finish_field_name,
+                                        baseline_late_start_field_name, baseline_late_finish_field_name,
+                                        update_early_start_field_name, update_early_finish_field_name,
+                                        update_late_start_field_name, update_late_finish_field_name,
+                                        update_actual_start_field_name, update_actual_finish_field_name,
+                                        fix_zero_actual_duration_flag, update_data_date):
+    '''
+    Row by row earned duration of the original implementation (text date fields), used as the reference for output-equivalence checks of calculate_earned_duration.
+    '''
+    from dateutil import parser
+
+    df_baseline_tasks = df_baseline_tasks.copy()
+    df_update_tasks = df_update_tasks.copy()
+    num_update_columns = len(df_update_tasks.columns)
+    time_phase = reference_time_phase_monthly
+    polarize = lambda df: reference_polarize_update_schedule(df, update_data_date, update_early_start_field_name, update_early_finish_field_name,
+                                                             update_late_start_field_name, update_late_finish_field_name,
+                                                             update_actual_start_field_name, update_actual_finish_field_name)
+
+    # Calculating Baseline Duration (Early_Finish - Early_Start)
+    df_baseline_tasks['baseline_duration'] = pd.to_datetime(df_baseline_tasks[baseline_early_finish_field_name]) - pd.to_datetime(df_baseline_tasks[baseline_early_start_field_name])
+
+    # Finding Added/Removed and matched Activities
+    df_removed = df_baseline_tasks[~(df_baseline_tasks[id_field_name].isin(df_update_tasks[id_field_name]))]
+    df_added = df_update_tasks[~(df_update_tasks[id_field_name].isin(df_baseline_tasks[id_field_name]))]
+    df_baseline_matched = df_baseline_tasks[df_baseline_tasks[id_field_name].isin(df_update_tasks[id_field_name])]
+    df_update_matched = df_update_tasks[df_update_tasks[id_field_name].isin(df_baseline_tasks[id_field_name])]
+    df_update_matched = df_update_matched.merge(df_baseline_matched[[id_field_name, 'baseline_duration']], left_on = id_field_name, right_on = id_field_name, how = 'inner')
+
+    # Fixing activities with 0 At Completion Duration
+    if fix_zero_actual_duration_flag == True:
+        for i, row in df_update_matched.loc[(df_update_matched[update_actual_start_field_name] != '') & (df_update_matched[update_actual_finish_field_name] != ''), :].iterrows():
+            if parser.parse(row[update_actual_finish_field_name]) == parser.parse(row[update_actual_start_field_name]):
+                df_update_matched.loc[i, update_actual_start_field_name] = parser.parse(df_update_matched.loc[i, update_actual_finish_field_name]) - df_update_matched.loc[i, 'baseline_duration']
+
+    # Calculating At-Completion Duration for completed, in-progress and not started activities
+    has_actual_start = df_update_matched[update_actual_start_field_name] != ''
+    has_actual_finish = df_update_matched[update_actual_finish_field_name] != ''
+    for mask, start_field_name, finish_field_name in [(has_actual_start & has_actual_finish, update_actual_start_field_name, update_actual_finish_field_name),
+                                                      (has_actual_start & ~has_actual_finish, update_actual_start_field_name, update_early_finish_field_name),
+                                                      (~has_actual_start & ~has_actual_finish, update_early_start_field_name, update_early_finish_field_name)]:
+        df_update_matched.loc[mask, 'at_completion_duration'] = pd.to_datetime(df_update_matched.loc[mask, finish_field_name]) - pd.to_datetime(df_update_matched.loc[mask, start_field_name])
+
+    # Time Phasing Matched, Removed and Added
+    df_update_matched_plan, df_update_matched_actual = polarize(df_update_matched)
+    df_baseline_matched_early_time_phased = time_phase(df_baseline_matched, id_field_name, baseline_early_start_field_name, baseline_early_finish_field_name)
+    df_baseline_matched_late_time_phased = time_phase(df_baseline_matched, id_field_name, baseline_late_start_field_name, baseline_late_finish_field_name)
+    df_update_matched_actual_time_phased = time_phase(df_update_matched_actual, id_field_name, 'act_start_date_adjusted', 'act_end_date_adjusted')
+    df_update_matched_plan_early_time_phased = time_phase(df_update_matched_plan, id_field_name, 'early_start_date_adjusted', 'early_end_date_adjusted')
+    df_update_matched_plan_late_time_phased = time_phase(df_update_matched_plan, id_field_name, 'late_start_date_adjusted', 'late_end_date_adjusted')
+    df_removed_time_phased = time_phase(df_removed, id_field_name, baseline_early_start_field_name, baseline_early_finish_field_name) if df_removed.shape[0] != 0 else None
+    if df_added.shape[0] != 0:
+        df_added_plan, df_added_actual = polarize(df_added)
+        df_added_plan_time_phased = time_phase(df_added_plan, id_field_name, 'early_start_date_adjusted', 'early_end_date_adjusted') if df_added_plan.shape[0] != 0 else pd.DataFrame()
+        df_added_actual_time_phased = time_phase(df_added_actual, id_field_name, 'act_start_date_adjusted', 'act_end_date_adjusted') if df_added_actual.shape[0] != 0 else pd.DataFrame()
+    else:
+        df_added_plan_time_phased = None
+        df_added_actual_time_phased = None
+
+    # Calculate earned duration for matched Actual
+    df_earned_matched_time_phased = df_update_matched_actual_time_phased.copy()
+    df_earned_matched_time_phased = df_earned_matched_time_phased[(df_earned_matched_time_phased['baseline_duration'] != datetime.timedelta(0.0)) & (df_earned_matched_time_phased['at_completion_duration'] != datetime.timedelta(0.0))]
+    df_earned_matched_time_phased.iloc[:, num_update_columns + 4:] = df_earned_matched_time_phased.iloc[:, num_update_columns + 4:].mul(
+        df_earned_matched_time_phased.apply(lambda row: row['baseline_duration'] / row['at_completion_duration'], axis = 1), axis = 0)
+
+    return (df_baseline_matched_early_time_phased, df_baseline_matched_late_time_phased, df_update_matched_actual_time_phased, df_update_matched_plan_early_time_phased,
+            df_update_matched_plan_late_time_phased, df_removed_time_phased, df_added_plan_time_phased, df_added_actual_time_phased, df_earned_matched_time_phased)
+
+def _normalize_dates(df):
+    ''' Converts text date columns to datetime64 so outputs of the original (text) and columnar (datetime64) implementations compare equal.'''
+    df = df.copy()
+    for col in df.columns:
+        if df[col].dtype == object and (str(col).endswith('_date') or str(col).endswith('_date_adjusted')):
+            df[col] = pd.to_datetime(df[col])
+    return df
+
+
+def check_equivalence(baseline_file_name, update_file_name, lst_wbs_inclusions=None, lst_wbs_exclusions=None):
+    '''
+    Checks that the faster engines return the same outputs as the reference implementations on a baseline/update pair.
+    Returns a data frame of check names, pass flags and messages.
+    '''
+    df_baseline_xer, baseline_data_date = lb_edm_util.read_xer(baseline_file_name)
+    df_update_xer, update_data_date = lb_edm_util.read_xer(update_file_name)
+    if lst_wbs_inclusions is None:
+        lst_wbs_inclusions, lst_wbs_exclusions = get_benchmark_wbs_paths(df_update_xer)
+    df_tasks = df_update_xer['TASK']
+    lst_checks = []
+
+    def check(name, func):
+        try:
+            func()
+            lst_checks.append((name, True, ''))
+        except AssertionError as e:
+            lst_checks.append((name, False, str(e)))
+
+    def assert_none(df):
+        assert df is None, 'expected no output'
+
+    for start_field_name, finish_field_name in [('early_start_date', 'early_end_date'), ('target_start_date', 'target_end_date')]:
+        df_reference = reference_time_phase_monthly(df_tasks, 'task_id', start_field_name, finish_field_name)
+        check('time_phase_monthly %s' % start_field_name, lambda: pd.testing.assert_frame_equal(
+            lb_edm_util.time_phase_monthly(df_tasks.copy(), 'task_id', start_field_name, finish_field_name), df_reference, check_dtype = False))
+        df_copy = df_tasks.copy()
+        check('time_phase_sparse %s' % start_field_name, lambda: pd.testing.assert_frame_equal(
+            lb_edm_util.time_phase_sparse(df_copy, 'task_id', start_field_name, finish_field_name)[0].to_wide(df_copy), df_reference, check_dtype = False))
+
+    check('get_tasks_by_wbs_paths', lambda: pd.testing.assert_frame_equal(
+        lb_edm_util.get_tasks_by_wbs_paths(lst_wbs_inclusions, lst_wbs_exclusions, df_update_xer),
+        reference_get_tasks_by_wbs_paths(lst_wbs_inclusions, lst_wbs_exclusions, df_update_xer)))
+    check('get_task_activity_code_assignments', lambda: pd.testing.assert_frame_equal(
+        lb_edm_util.get_task_activity_code_assignments(df_update_xer, 'CSI'), reference_get_task_activity_code_assignments(df_update_xer, 'CSI'), check_dtype = False))
+
+    # Columnar engine against the original implementation
+    df_baseline_tasks = df_baseline_xer['TASK']
+    lst_columnar = lb_edm_util.calculate_earned_duration(df_baseline_tasks.copy(), df_tasks.copy(), *(EDM_FIELD_NAMES + [True, update_data_date]))
+    # The original implementation aligns a data date series on the task index, so it is given the scalar data date
+    lst_original = reference_calculate_earned_duration(df_baseline_tasks, df_tasks, *(EDM_FIELD_NAMES + [True, update_data_date.iloc[0]]))
+    for j, (df_original, df_result) in enumerate(zip(lst_original, lst_columnar)):
+        if df_original is None:
+            check('calculate_earned_duration original output %d' % j, lambda: assert_none(df_result))
+        else:
+            check('calculate_earned_duration original output %d' % j, lambda: pd.testing.assert_frame_equal(
+                _normalize_dates(df_result), _normalize_dates(df_original), check_dtype = False))
+    
+    # Shared baseline and incremental runs against a plain run
+    baseline_time_phased = lb_edm_util.time_phase_baseline(df_baseline_tasks.copy(), *EDM_FIELD_NAMES[:5])
+    incremental_state = {}
+    for i in range(2):
+        lst_results = lb_edm_util.calculate_earned_duration(df_baseline_tasks.copy(), df_tasks.copy(), *(EDM_FIELD_NAMES + [True, update_data_date]),
+                                                            baseline_time_phased = baseline_time_phased, incremental_state = incremental_state)
+        for j, (df_columnar, df_result) in enumerate(zip(lst_columnar, lst_results)):
+            if df_columnar is None:
+                check('calculate_earned_duration run %d output %d' % (i, j), lambda: assert_none(df_result))
+            else:
+                check('calculate_earned_duration run %d output %d' % (i, j), lambda: pd.testing.assert_frame_equal(df_result, df_columnar))
+
+    # Completed activities with zero actual duration earn their baseline working days on calendars
+    df_zero_tasks = df_tasks.copy()
+    zero_index = df_zero_tasks.index[df_zero_tasks['act_start_date'].notnull() & df_zero_tasks['act_end_date'].notnull()][:50]
+    df_zero_tasks.loc[zero_index, 'act_start_date'] = df_zero_tasks.loc[zero_index, 'act_end_date']
+    df_earned = lb_edm_util.calculate_earned_duration(df_baseline_tasks.copy(), df_zero_tasks, *(EDM_FIELD_NAMES + [True, update_data_date]),
+                                                      calendars = lb_edm_util.WorkingCalendars(df_update_xer['CALENDAR']))[8]
+    df_earned = df_earned[df_earned['task_id'].isin(df_zero_tasks.loc[zero_index, 'task_id'])]
+    check('calculate_earned_duration zero actual duration on calendars', lambda: np.testing.assert_allclose(
+        df_earned['baseline_duration'].values / df_earned['at_completion_duration'].values, 1.0))
+
+    return pd.DataFrame(lst_checks, columns = ['check', 'passed', 'message'])
+
+if __name__ == '__main__':
+    import argparse
+
+    arg_parser = argparse.ArgumentParser(description = 'Benchmarks the Earned Duration Methodology pipeline on synthetic XER files.')
+    arg_parser.add_argument('--sizes', type = int, nargs = '+', default = [1000, 10000, 100000], help = 'numbers of activities')
+    arg_parser.add_argument('--output', default = 'edm_benchmark.jsonl', help = 'file the results are appended to')
+    arg_parser.add_argument('--work-dir', default = '.', help = 'directory of generated XER files')
+    arg_parser.add_argument('--label', default = '', help = 'label of this run, used to compare runs')
+    arg_parser.add_argument('--wbs-depth', type = int, default = 3)
+    arg_parser.add_argument('--wbs-fan-out', type = int, default = 5)
+    arg_parser.add_argument('--code-depth', type = int, default = 2)
+    arg_parser.add_argument('--code-fan-out', type = int, default = 8)
+    arg_parser.add_argument('--span-days', type = int, default = 3 * 365)
+    arg_parser.add_argument('--share-complete', type = float, default = 0.4)
+    arg_parser.add_argument('--share-active', type = float, default = 0.1)
+    arg_parser.add_argument('--check', action = 'store_true', help = 'run output-equivalence checks on the smallest size first')
+    args = arg_parser.parse_args()
+
+    dict_options = {'wbs_depth': args.wbs_depth, 'wbs_fan_out': args.wbs_fan_out, 'code_depth': args.code_depth, 'code_fan_out': args.code_fan_out,
+                    'span_days': args.span_days, 'share_complete': args.share_complete, 'share_active': args.share_active}
+    if args.check:
+        baseline_file_name = os.path.join(args.work_dir, 'benchmark_check_baseline.xer')
+        update_file_name = os.path.join(args.work_dir, 'benchmark_check_update.xer')
+        generate_baseline_update_xer(baseline_file_name, update_file_name, num_activities = min(args.sizes), **dict_options)
+        print(check_equivalence(baseline_file_name, update_file_name).to_string())
+
+    print(run_benchmark(args.sizes, args.output, args.work_dir, args.label, **dict_options)[['num_activities', 'stage', 'seconds', 'peak_mb']].to_string())
@@ -0,0 +1,228 @@
+# global import statements
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import pandas as pd
+import numpy as np
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+from lb_edm_util import read_xer
+
+# Default upper bound of the cache directory size (bytes)
+DEFAULT_MAX_CACHE_BYTES = 4 * 1024 ** 3
+
+# Version of the on-disk layout, part of every cache key
+CACHE_FORMAT_VERSION = 3
+
+class LazyTableDict(MutableMapping):
+    ''' Dictionary of entity names and data frames where cached tables are only built from their memory-mapped columns when first accessed.'''
+
+    def __init__(self, entry_dir, dict_meta):
+        self._entry_dir = entry_dir
+        self._meta = dict_meta
+        self._tables = {}
+
+    def __getitem__(self, key):
+        if key not in self._tables:
+            if key not in self._meta:
+                raise KeyError(key)
+            self._tables[key] = _load_table(os.path.join(self._entry_dir, self._meta[key]['dir']), self._meta[key])
+        return self._tables[key]
+
+    def __setitem__(self, key, value):
+        self._tables[key] = value
+
+    def __delitem__(self, key):
+        if key not in self._tables and key not in self._meta:
+            raise KeyError(key)
+        self._tables.pop(key, None)
+        self._meta.pop(key, None)
+
+    def __iter__(self):
+        return iter(set(self._meta) | set(self._tables))
+
+    def __len__(self):
+        return len(set(self._meta) | set(self._tables))
+
+def _hash_file(file_name):
+    ''' Calculates the SHA-1 of a file's content.'''
+    h = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _get_content_hash(file_name, cache_dir):
+    ''' Returns the content hash of a file, rehashing only when its size or modification time has changed since it was last seen.'''
+    manifest_file = os.path.join(cache_dir, 'files.json')
+    try:
+        with open(manifest_file, 'r') as f:
+            dict_files = json.load(f)
+    except (IOError, OSError, ValueError):
+        dict_files = {}
+
+    path = os.path.abspath(file_name)
+    stat = os.stat(path)
+    seen = dict_files.get(path)
+    if seen is not None and seen[0] == stat.st_size and seen[1] == stat.st_mtime:
+        return seen[2]
+
+    # Stale or unseen file
+    content_hash = _hash_file(path)
+    dict_files[path] = [stat.st_size, stat.st_mtime, content_hash]
+    _write_json(manifest_file, dict_files)
+    return content_hash
+
+def _get_cache_key(content_hash, tables, columns, convert_types):
+    ''' Combines the content hash and the reader options into a cache key.'''
+    options = json.dumps([CACHE_FORMAT_VERSION,
+                          sorted(tables) if tables is not None else None,
+                          dict((k, sorted(v)) for k, v in columns.items()) if columns is not None else None,
+                          bool(convert_types)], sort_keys = True)
+    return hashlib.sha1((content_hash + options).encode('utf-8')).hexdigest()
+
+def _write_json(file_name, obj):
+    ''' Writes a json file atomically.'''
+    fd, tmp_file = tempfile.mkstemp(dir = os.path.dirname(file_name))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(obj, f)
+    try:
+        os.rename(tmp_file, file_name)
+    except OSError:
+        # Windows does not replace existing files on rename
+        os.remove(file_name)
+        os.rename(tmp_file, file_name)
+
+def _save_table(table_dir, df):
+    ''' Saves a data frame as one .npy file per column and returns its metadata.'''
+    os.mkdir(table_dir)
+    lst_columns = []
+    for i, col in enumerate(df.columns):
+        sr = df[col]
+        column_meta = {'name': col, 'file': '%d.npy' % i}
+        if sr.dtype.name == 'category':
+            column_meta['kind'] = 'category'
+            column_meta['categories'] = sr.cat.categories.tolist()
+            values = sr.cat.codes.values
+        elif sr.dtype == object:
+            # Text columns are stored as codes into their unique values, kept as UTF-8 bytes
+            column_meta['kind'] = 'text'
+            codes, uniques = pd.factorize(sr.values)
+            column_meta['uniques'] = len(uniques)
+            column_meta['text_file'] = '%d_text.npy' % i
+            text = u'\t'.join(uniques)
+            if text.count(u'\t') == max(len(uniques) - 1, 0):
+                # XER values never hold tabs: joining them with tabs lets them be decoded and split in one step
+                column_meta['separator'] = u'\t'
+                text = text.encode('utf-8')
+            else:
+                lst_encoded = [x.encode('utf-8') for x in uniques]
+                text = b''.join(lst_encoded)
+                column_meta['offsets_file'] = '%d_offsets.npy' % i
+                np.save(os.path.join(table_dir, column_meta['offsets_file']), np.cumsum([0] + [len(x) for x in lst_encoded]).astype(np.int64))
+            np.save(os.path.join(table_dir, column_meta['text_file']), np.frombuffer(text, dtype = np.uint8))
+            values = codes.astype(np.int32)
+        else:
+            column_meta['kind'] = 'array'
+            values = sr.values
+        np.save(os.path.join(table_dir, column_meta['file']), values)
+        lst_columns.append(column_meta)
+    return {'columns': lst_columns, 'rows': len(df)}
+
+def _load_table(table_dir, table_meta):
+    ''' Builds a data frame from memory-mapped .npy column files.'''
+    dict_columns = {}
+    for column_meta in table_meta['columns']:
+        values = np.load(os.path.join(table_dir, column_meta['file']), mmap_mode = 'r')
+        if column_meta['kind'] == 'category':
+            dict_columns[column_meta['name']] = pd.Categorical.from_codes(values, column_meta['categories'])
+        elif column_meta['kind'] == 'text':
+            text = np.load(os.path.join(table_dir, column_meta['text_file'])).tobytes()
+            if 'separator' not in column_meta:
+                offsets = np.load(os.path.join(table_dir, column_meta['offsets_file']))
+                lst_uniques = [text[start:end].decode('utf-8') for start, end in zip(offsets[:-1], offsets[1:])]
+            elif column_meta['uniques']:
+                lst_uniques = text.decode('utf-8').split(column_meta['separator'])
+            else:
+                lst_uniques = []
+            uniques = np.array(lst_uniques + [np.nan], dtype = object)
+            # Code -1 (missing value) picks the trailing NaN
+            dict_columns[column_meta['name']] = uniques[values]
+        else:
+            dict_columns[column_meta['name']] = values
+    return pd.DataFrame(dict_columns, index = pd.RangeIndex(table_meta['rows']), columns = [x['name'] for x in table_meta['columns']])
+
+def _get_dir_size(path):
+    ''' Returns the total size of the files under a directory.'''
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            size += os.path.getsize(os.path.join(root, name))
+    return size
+
+def evict_xer_cache(cache_dir, max_cache_bytes=DEFAULT_MAX_CACHE_BYTES, keep_entry_dir=None):
+    ''' Deletes least recently used cache entries until the cache is under max_cache_bytes, never deleting keep_entry_dir (an entry still being read).'''
+    lst_entries = []
+    for name in os.listdir(cache_dir):
+        entry_dir = os.path.join(cache_dir, name)
+        meta_file = os.path.join(entry_dir, 'meta.json')
+        if os.path.isdir(entry_dir) and os.path.exists(meta_file) and entry_dir != keep_entry_dir:
+            lst_entries.append((os.path.getmtime(meta_file), _get_dir_size(entry_dir), entry_dir))
+
+    total_size = sum(x[1] for x in lst_entries)
+    if keep_entry_dir is not None and os.path.isdir(keep_entry_dir):
+        total_size += _get_dir_size(keep_entry_dir)
+    for last_used, size, entry_dir in sorted(lst_entries):
+        if total_size <= max_cache_bytes:
+            break
+        shutil.rmtree(entry_dir, ignore_errors = True)
+        total_size -= size
+
+def read_xer_cached(file_name, cache_dir, tables=None, columns=None, convert_types=False, max_cache_bytes=DEFAULT_MAX_CACHE_BYTES):
+    ''' Same as read_xer but keeps parsed tables in a columnar on-disk cache keyed by the file's content hash and the reader options.
+
+    Cached tables are memory-mapped and only built when accessed through the returned dictionary.
+    The cache is trimmed to max_cache_bytes by evicting least recently used entries.
+    '''
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    key = _get_cache_key(_get_content_hash(file_name, cache_dir), tables, columns, convert_types)
+    entry_dir = os.path.join(cache_dir, key)
+    meta_file = os.path.join(entry_dir, 'meta.json')
+
+    # Cache hit: marking entry as recently used
+    if os.path.exists(meta_file):
+        with open(meta_file, 'r') as f:
+            dict_meta = json.load(f)
+        os.utime(meta_file, None)
+        # Keeping the cache bounded on hits too; the tables of this entry are only built when accessed
+        evict_xer_cache(cache_dir, max_cache_bytes, keep_entry_dir = entry_dir)
+        dict_tables = LazyTableDict(entry_dir, dict_meta)
+        return dict_tables, pd.to_datetime(dict_tables['PROJECT']['last_recalc_date'])
+
+    # Cache miss: parsing XER file and writing every table into a temporary entry
+    dict_tables, data_date = read_xer(file_name, tables = tables, columns = columns, convert_types = convert_types)
+
+    tmp_dir = tempfile.mkdtemp(dir = cache_dir, prefix = '.tmp-')
+    try:
+        dict_meta = {}
+        for i, tbl_name in enumerate(sorted(dict_tables)):
+            dict_meta[tbl_name] = _save_table(os.path.join(tmp_dir, str(i)), dict_tables[tbl_name])
+            dict_meta[tbl_name]['dir'] = str(i)
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump(dict_meta, f)
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        # Another process stored the same entry first
+        shutil.rmtree(tmp_dir, ignore_errors = True)
+
+    evict_xer_cache(cache_dir, max_cache_bytes)
+
+    return dict_tables, data_date
@@ -0,0 +1,273 @@
+# global import statements
+import os
+import io
+import time
+import shutil
+import tempfile
+import pandas as pd
+
+from lb_edm_util import read_xer, get_tasks_by_wbs_paths, calculate_earned_duration, _to_datetime64, _get_max_rss
+
+# Tables written to project partitions by default
+DEFAULT_PARTITION_TABLES = ['PROJECT', 'CALENDAR', 'PROJWBS', 'TASK', 'TASKACTV', 'ACTVTYPE', 'ACTVCODE']
+
+# Estimated working memory of a project (bytes) per byte of its baseline and update partition files
+PARTITION_MEMORY_FACTOR = 24
+
+# File names of the calculate_earned_duration outputs written for each project
+EDM_OUTPUT_NAMES = ['baseline_matched_early', 'baseline_matched_late', 'update_matched_actual',
+                    'update_matched_plan_early', 'update_matched_plan_late', 'removed',
+                    'added_plan', 'added_actual', 'earned_matched']
+
+def read_xer_projects(file_name):
+    ''' Returns the PROJECT table of an XER file (indexed by proj_id) without reading the rest of the file.'''
+    lst_rows = None
+    with io.open(file_name, "r", encoding="ISO-8859-1") as f:
+        for line in f:
+            if line.startswith('%T'):
+                if lst_rows is not None:
+                    break
+                if line.rstrip('\r\n').split('\t')[1].strip() == 'PROJECT':
+                    lst_rows = []
+            elif line.startswith('%F') and lst_rows is not None:
+                lst_fields = line.rstrip('\r\n').split('\t')[1:]
+            elif line.startswith('%R') and lst_rows is not None:
+                values = line.rstrip('\r\n').split('\t')[1:]
+                lst_rows.append(values + [''] * (len(lst_fields) - len(values)))
+            elif line.startswith('%E'):
+                break
+
+    if lst_rows is None:
+        raise ValueError('No PROJECT table in ' + file_name)
+    df_projects = pd.DataFrame.from_records(data = lst_rows, columns = lst_fields)
+    df_projects['last_recalc_date'] = pd.to_datetime(df_projects['last_recalc_date'])
+    return df_projects.set_index('proj_id', drop = False)
+
+def split_xer_by_project(file_name, partition_dir, tables=DEFAULT_PARTITION_TABLES):
+    '''
+    Splits a multi-project XER file into one XER file per project in partition_dir, streaming it without holding any table in memory.
+
+    Rows of tables with a proj_id field go to the partition of their project; rows without one (e.g. global calendars and activity codes) go to every partition.
+    Only the listed tables are written (all tables if None).
+    Returns the PROJECT table indexed by proj_id with the file_name and file_size of each partition.
+    '''
+    df_projects = read_xer_projects(file_name)
+    if not os.path.isdir(partition_dir):
+        os.makedirs(partition_dir)
+
+    # Opening one partition file per project
+    dict_files = {}
+    for proj_id in df_projects.index:
+        dict_files[proj_id.encode('ascii')] = open(os.path.join(partition_dir, proj_id + '.xer'), 'wb')
+
+    try:
+        tbl_name = None
+        keep = False
+        with open(file_name, 'rb') as f:
+            for line in f:
+                if line.startswith(b'%R'):
+                    if not keep:
+                        continue
+                    partition = line.rstrip(b'\r\n').split(b'\t')[proj_id_index] if proj_id_index is not None else b''
+                    if partition in dict_files:
+                        dict_files[partition].write(line)
+                    elif partition.strip() == b'':
+                        for partition in dict_files:
+                            dict_files[partition].write(line)
+                elif line.startswith(b'%T'):
+                    tbl_line = line
+                    tbl_name = line.rstrip(b'\r\n').split(b'\t')[1].strip().decode('ISO-8859-1')
+                    keep = tables is None or tbl_name in tables
+                elif line.startswith(b'%F'):
+                    lst_fields = line.rstrip(b'\r\n').split(b'\t')
+                    proj_id_index = lst_fields.index(b'proj_id') if b'proj_id' in lst_fields else None
+                    # Every partition gets every kept table, even a project without rows in it
+                    if keep:
+                        for partition in dict_files:
+                            dict_files[partition].write(tbl_line + line)
+                elif line.startswith(b'%E'):
+                    break
+                elif tbl_name is None:
+                    # Copying the ERMHDR header line
+                    for partition in dict_files:
+                        dict_files[partition].write(line)
+        for partition in dict_files:
+            dict_files[partition].write(b'%E\r\n')
+    finally:
+        for partition in dict_files:
+            dict_files[partition].close()
+
+    df_projects['file_name'] = [os.path.join(partition_dir, x + '.xer') for x in df_projects.index]
+    df_projects['file_size'] = [os.path.getsize(x) for x in df_projects['file_name']]
+    return df_projects
+
+def read_project_results(output_dir, project):
+    ''' Reads the calculate_earned_duration outputs written for a project by calculate_earned_duration_partitioned (None for outputs without activities).'''
+    lst_results = []
+    for i, name in enumerate(EDM_OUTPUT_NAMES):
+        file_name = os.path.join(output_dir, project, '%d_%s.pkl' % (i, name))
+        lst_results.append(pd.read_pickle(file_name) if os.path.exists(file_name) else None)
+    return tuple(lst_results)
+
+_partition_state = {}
+
+def _init_partition_worker(dict_state):
+    ''' Stores the run settings in a partition worker process.'''
+    _partition_state.update(dict_state)
+
+def _calculate_earned_duration_for_project(job):
+    '''
+    Reads, filters and calculates earned duration of one project's baseline and update partitions and writes the outputs to disk.
+    An error is returned as a failed status so that the other projects keep running.
+    '''
+    s = _partition_state
+    project, baseline_file_name, update_file_name = job
+    start = time.time()
+
+    try:
+        lst_tasks = []
+        for file_name in [baseline_file_name, update_file_name]:
+            df_xer, data_date = read_xer(file_name, tables = ['PROJWBS', 'TASK'])
+            if s['lst_wbs_inclusions'] is None:
+                lst_tasks.append(df_xer['TASK'])
+            else:
+                lst_tasks.append(get_tasks_by_wbs_paths(s['lst_wbs_inclusions'], s['lst_wbs_exclusions'], df_xer))
+            del df_xer
+
+        # Each project is measured at its own data date (last_recalc_date of the update partition)
+        data_date = _to_datetime64(data_date)
+        edm_results = calculate_earned_duration(lst_tasks[0].copy(), lst_tasks[1], *(s['lst_field_names'] + [s['fix_zero_actual_duration_flag'], data_date]))
+
+        # Writing outputs so that results are not held in memory
+        project_dir = os.path.join(s['output_dir'], project)
+        if not os.path.isdir(project_dir):
+            os.makedirs(project_dir)
+        for i, name in enumerate(EDM_OUTPUT_NAMES):
+            if edm_results[i] is not None:
+                edm_results[i].to_pickle(os.path.join(project_dir, '%d_%s.pkl' % (i, name)))
+    except Exception as e:
+        return _get_failed_result(e, start)
+
+    return {'status': 'calculated', 'data_date': data_date, 'baseline_activities': len(lst_tasks[0]), 'update_activities': len(lst_tasks[1]),
+            'seconds': time.time() - start, 'max_rss_mb': _get_max_rss()}
+
+def _get_failed_result(error, start=None):
+    ''' Returns the result of a project that raised error.'''
+    return {'status': 'failed', 'error': '%s: %s' % (type(error).__name__, error),
+            'seconds': time.time() - start if start is not None else None}
+
+def _run_with_memory_ceiling(lst_jobs, lst_estimates, num_workers, max_memory_bytes):
+    '''
+    Runs jobs in a pool of num_workers processes, starting a job only while the estimated memory of the running jobs stays under max_memory_bytes.
+    A job larger than the ceiling runs alone. Returns the results in the order of the jobs.
+    '''
+    import multiprocessing
+
+    # Largest jobs first, smaller jobs fill the remaining room
+    lst_pending = sorted(range(len(lst_jobs)), key = lambda i: -lst_estimates[i])
+    dict_running = {}
+    lst_results = [None] * len(lst_jobs)
+
+    # One project per worker process so its memory is returned once it ends
+    pool = multiprocessing.Pool(num_workers, initializer = _init_partition_worker, initargs = (_partition_state,), maxtasksperchild = 1)
+    try:
+        while lst_pending or dict_running:
+            running_bytes = sum(lst_estimates[i] for i in dict_running)
+            for i in list(lst_pending):
+                if len(dict_running) >= num_workers:
+                    break
+                if not dict_running or max_memory_bytes is None or running_bytes + lst_estimates[i] <= max_memory_bytes:
+                    dict_running[i] = pool.apply_async(_calculate_earned_duration_for_project, (lst_jobs[i],))
+                    running_bytes += lst_estimates[i]
+                    lst_pending.remove(i)
+
+            # Waiting for any running job to finish
+            lst_ready = []
+            while not lst_ready:
+                for i in dict_running:
+                    dict_running[i].wait(0.05)
+                    if dict_running[i].ready():
+                        lst_ready.append(i)
+            for i in lst_ready:
+                # Errors raised outside the project (e.g. a result that cannot be pickled) fail only that project
+                try:
+                    lst_results[i] = dict_running.pop(i).get()
+                except Exception as e:
+                    lst_results[i] = _get_failed_result(e)
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return lst_results
+
+def calculate_earned_duration_partitioned(baseline_file_name, update_file_name, output_dir, lst_wbs_inclusions, lst_wbs_exclusions,
+                                          id_field_name, baseline_early_start_field_name, baseline_early_finish_field_name,
+                                          baseline_late_start_field_name, baseline_late_finish_field_name,
+                                          update_early_start_field_name, update_early_finish_field_name,
+                                          update_late_start_field_name, update_late_finish_field_name,
+                                          update_actual_start_field_name, update_actual_finish_field_name,
+                                          fix_zero_actual_duration_flag, num_workers=None, max_memory_mb=None,
+                                          project_field_name='proj_short_name', partition_dir=None):
+    '''
+    Calculates earned duration of every project of a multi-project baseline XER file against a multi-project update XER file.
+
+    Both files are split by proj_id into partition_dir (a temporary directory if None) and projects are matched on project_field_name.
+    WBS filtering, time-phasing and earned duration run per project, at the project's own data date, in a pool of num_workers processes (all cores if None, in-process if 1).
+    Projects are started only while their estimated memory (PARTITION_MEMORY_FACTOR times their partition sizes) stays under max_memory_mb.
+    The outputs of each project are written to output_dir/<project> and can be read with read_project_results.
+    Returns a data frame with one row per project and its status (calculated, failed, no_baseline or no_update), data date, activity counts, run time, peak memory and error.
+    A failed project does not stop the others.
+    '''
+    import multiprocessing
+
+    remove_partitions = partition_dir is None
+    if partition_dir is None:
+        partition_dir = tempfile.mkdtemp(prefix = 'edm-partitions-')
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    try:
+        # Splitting baseline and update by project
+        df_baseline_projects = split_xer_by_project(baseline_file_name, os.path.join(partition_dir, 'baseline'))
+        df_update_projects = split_xer_by_project(update_file_name, os.path.join(partition_dir, 'update'))
+
+        # Matching projects of baseline and update
+        df_projects = df_baseline_projects[[project_field_name, 'proj_id', 'file_name', 'file_size']].merge(
+            df_update_projects[[project_field_name, 'proj_id', 'file_name', 'file_size']], on = project_field_name, how = 'outer', suffixes = ('_baseline', '_update'))
+        df_projects = df_projects.rename(columns = {project_field_name: 'project'})
+        df_projects['status'] = 'no_update'
+        df_projects.loc[df_projects['proj_id_baseline'].isnull(), 'status'] = 'no_baseline'
+        matched = df_projects['proj_id_baseline'].notnull() & df_projects['proj_id_update'].notnull()
+        df_projects.loc[matched, 'status'] = 'calculated'
+        df_projects['estimated_mb'] = (df_projects['file_size_baseline'].fillna(0) + df_projects['file_size_update'].fillna(0)) * PARTITION_MEMORY_FACTOR / 1024.0 ** 2
+
+        _partition_state.update({'output_dir': output_dir,
+                                 'lst_wbs_inclusions': lst_wbs_inclusions,
+                                 'lst_wbs_exclusions': lst_wbs_exclusions,
+                                 'fix_zero_actual_duration_flag': fix_zero_actual_duration_flag,
+                                 'lst_field_names': [id_field_name, baseline_early_start_field_name, baseline_early_finish_field_name,
+                                                     baseline_late_start_field_name, baseline_late_finish_field_name,
+                                                     update_early_start_field_name, update_early_finish_field_name,
+                                                     update_late_start_field_name, update_late_finish_field_name,
+                                                     update_actual_start_field_name, update_actual_finish_field_name]})
+
+        # Processing matched projects
+        df_matched = df_projects[matched]
+        lst_jobs = list(zip(df_matched['project'], df_matched['file_name_baseline'], df_matched['file_name_update']))
+        if num_workers == 1:
+            lst_results = [_calculate_earned_duration_for_project(x) for x in lst_jobs]
+        else:
+            lst_estimates = (df_matched['estimated_mb'] * 1024.0 ** 2).tolist()
+            lst_results = _run_with_memory_ceiling(lst_jobs, lst_estimates, num_workers or multiprocessing.cpu_count(),
+                                                   max_memory_mb * 1024.0 ** 2 if max_memory_mb is not None else None)
+    finally:
+        if remove_partitions:
+            shutil.rmtree(partition_dir, ignore_errors = True)
+
+    # Summarizing projects, failed projects keep their error
+    df_results = pd.DataFrame(lst_results, index = df_matched.index, columns = ['status', 'data_date', 'baseline_activities', 'update_activities', 'seconds', 'max_rss_mb', 'error'])
+    df_projects.loc[matched, 'status'] = df_results['status']
+    df_summary = df_projects[['project', 'proj_id_baseline', 'proj_id_update', 'status', 'estimated_mb']].join(df_results.drop('status', axis = 1))
+    df_summary['output_dir'] = [os.path.join(output_dir, x) if y == 'calculated' else None for x, y in zip(df_summary['project'], df_summary['status'])]
+    df_summary.to_csv(os.path.join(output_dir, 'summary.csv'), index = False)
+    return df_summary
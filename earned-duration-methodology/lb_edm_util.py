@@ -2,75 +2,713 @@
 import pandas as pd
 import numpy as np
 import datetime
-from dateutil.relativedelta import relativedelta
-from dateutil import parser
+import re
+import sys
+import time
+import hashlib
 
-def read_xer(file_name):
-    ''' Opens an Primavera P6 XER file and returns a dictionary of entity names and data frames containing values.'''
+try:
+    import resource
+except ImportError:
+    resource = None
+
+class Instrumentation(object):
+    '''
+    Collects wall time, rows in and out and peak memory of named pipeline stages and the data-quality issues they find, forwarding every record to callbacks.
+    
+    Pass an instance as instrumentation to read_xer, get_tasks_by_wbs_paths, time_phase_baseline or calculate_earned_duration; nothing is recorded without one.
+    The functions keep returning their usual results: stage metrics and issues are read from the instance (get_stage_report, get_issue_report) after the call.
+    
+    By default max_rss_mb is the process peak resident set size so far and max_rss_growth_mb its growth during the stage (rss_scope 'process'),
+    which stays at 0 for stages peaking below an earlier stage.
+    With reset_peak_rss (Linux) they are the peak during the stage and its growth over the resident set size at the start of the stage (rss_scope 'stage').
+    This resets the peak of the whole process through /proc/self/clear_refs at the start of every stage, so ru_maxrss and VmHWM
+    read anywhere else in the process (or by outside monitoring) only cover the time since the last stage started.
+    '''
+    
+    enabled = True
+    
+    def __init__(self, callbacks=None, reset_peak_rss=False):
+        self.callbacks = list(callbacks) if callbacks is not None else []
+        self.reset_peak_rss = reset_peak_rss
+        self.stages = []
+        self.issues = []
+    
+    def stage(self, name, rows_in=None):
+        ''' Returns a context manager recording a stage; rows_out can be set on the record dictionary it yields.'''
+        return _InstrumentedStage(self, name, rows_in)
+    
+    def add_issue(self, stage, issue, ids=None):
+        ''' Records a data-quality issue found by a stage, optionally with the ids of the activities concerned.'''
+        record = {'type': 'issue', 'stage': stage, 'issue': issue, 'ids': list(ids) if ids is not None else []}
+        record['count'] = len(record['ids'])
+        self.issues.append(record)
+        self._emit(record)
+    
+    def _emit(self, record):
+        for callback in self.callbacks:
+            callback(record)
+    
+    def get_stage_report(self):
+        ''' Returns one row per recorded stage.'''
+        return pd.DataFrame(self.stages, columns = ['stage', 'seconds', 'rows_in', 'rows_out', 'max_rss_mb', 'max_rss_growth_mb', 'rss_scope'])
+    
+    def get_issue_report(self):
+        ''' Returns one row per stage, issue and activity id (id is None for issues without activities).'''
+        return pd.DataFrame([(x['stage'], x['issue'], i) for x in self.issues for i in (x['ids'] or [None])], columns = ['stage', 'issue', 'id'])
+
+class _InstrumentedStage(object):
+    ''' Context manager timing one stage of an Instrumentation.'''
+    
+    def __init__(self, instrumentation, name, rows_in):
+        self.instrumentation = instrumentation
+        self.record = {'type': 'stage', 'stage': name, 'rows_in': rows_in, 'rows_out': None}
+    
+    def __enter__(self):
+        self.peak_memory = _PeakMemory(self.instrumentation.reset_peak_rss)
+        self.start = time.time()
+        return self.record
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.record['seconds'] = time.time() - self.start
+        self.record['max_rss_mb'], self.record['max_rss_growth_mb'], self.record['rss_scope'] = self.peak_memory.stop()
+        self.instrumentation.stages.append(self.record)
+        self.instrumentation._emit(self.record)
+        return False
+
+class _NullInstrumentation(object):
+    ''' Instrumentation used when none is given: records nothing.'''
+    
+    enabled = False
+    
+    def stage(self, name, rows_in=None):
+        return _NULL_STAGE
+    
+    def add_issue(self, stage, issue, ids=None):
+        pass
+
+class _NullStage(object):
+    def __enter__(self):
+        return {}
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_STAGE = _NullStage()
+_NULL_INSTRUMENTATION = _NullInstrumentation()
+
+def _get_max_rss():
+    ''' Returns the maximum resident set size of the process in MB (None where the resource module is not available).'''
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024.0 ** 2 if sys.platform == 'darwin' else 1024.0)
+
+def _get_rss():
+    ''' Returns the current and peak resident set size of the process in MB from /proc (None where not available).'''
+    try:
+        with open('/proc/self/status', 'r') as f:
+            status = f.read()
+        return int(re.search(r'VmRSS:\s+(\d+)', status).group(1)) / 1024.0, int(re.search(r'VmHWM:\s+(\d+)', status).group(1)) / 1024.0
+    except (IOError, OSError, AttributeError):
+        return None
+
+def _reset_peak_rss():
+    ''' Resets the peak resident set size of the process to its current size (Linux 4.0+); returns whether it was reset.'''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+class _PeakMemory(object):
+    '''
+    Measures the peak resident set size of a block of code from its creation to stop().
+    
+    By default it reads the process peak so far (ru_maxrss) and leaves it untouched.
+    With reset_peak_rss, where the peak can be reset (Linux), the process peak is reset to the current size so the measure covers the block only;
+    every other reader of ru_maxrss or VmHWM in the process then sees the reset peak. Nested blocks hand their peak over to the enclosing block.
+    '''
+    
+    _open = []
+    
+    def __init__(self, reset_peak_rss=False):
+        rss = _get_rss() if reset_peak_rss else None
+        if rss is not None and _PeakMemory._open:
+            # Keeping the peak of the enclosing block so far before resetting it
+            _PeakMemory._open[-1].peak = max(_PeakMemory._open[-1].peak, rss[1])
+        self.per_block = rss is not None and _reset_peak_rss()
+        if self.per_block:
+            self.start_rss, self.peak = rss[0], rss[0]
+            _PeakMemory._open.append(self)
+        else:
+            self.start_rss = _get_max_rss()
+    
+    def stop(self):
+        ''' Returns the peak (MB), its growth over the start (MB) and the scope of the measure ('stage' or 'process').'''
+        if not self.per_block:
+            peak = _get_max_rss()
+            return peak, None if peak is None else peak - self.start_rss, 'process'
+        
+        peak = max(self.peak, _get_rss()[1])
+        _PeakMemory._open.remove(self)
+        if _PeakMemory._open:
+            _PeakMemory._open[-1].peak = max(_PeakMemory._open[-1].peak, peak)
+        return peak, peak - self.start_rss, 'stage'
+
+# Field name patterns used to assign compact dtypes when reading XER tables
+XER_CATEGORICAL_FIELDS = ['status_code', 'task_type', 'duration_type', 'complete_pct_type', 'priority_type',
+                          'float_path', 'actv_code_type', 'actv_code_type_scope', 'proj_node_flag', 'status_reviewer']
+
+def convert_xer_types(df):
+    ''' Converts XER text columns into compact dtypes: datetime64 for dates, integers for ids, floats for counts, quantities and costs and categoricals for flags and codes.'''
+    for col in df.columns:
+        if col.endswith('_date'):
+            df[col] = pd.to_datetime(df[col], errors='coerce')
+        elif col.endswith('_id'):
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+            # Blank ids (e.g. root parents) are kept as NaN in a float column
+            if df[col].notnull().all():
+                df[col] = df[col].astype(np.int32 if df[col].abs().max() < 2 ** 31 else np.int64)
+        elif col.endswith('_cnt') or col.endswith('_qty') or col.endswith('_cost'):
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+        elif col.endswith('_flag') or col in XER_CATEGORICAL_FIELDS:
+            df[col] = df[col].astype('category')
+    return df
+
+def read_xer(file_name, tables=None, columns=None, convert_types=False, instrumentation=None):
+    ''' Opens an Primavera P6 XER file and returns a dictionary of entity names and data frames containing values.
+    
+    The file is streamed once. Only the tables listed in tables (all tables if None) are built, and columns may map a table name to the list of columns to keep.
+    If convert_types is True, columns are converted by convert_xer_types instead of being kept as text.
+    '''
+    if instrumentation is None:
+        instrumentation = _NULL_INSTRUMENTATION
+    
+    with instrumentation.stage('parse') as record:
+        dict, data_date = _read_xer_tables(file_name, tables, columns, convert_types)
+        record['rows_out'] = sum(len(x) for x in dict.values())
+    
+    return dict, data_date
+
+def _read_xer_tables(file_name, tables, columns, convert_types):
+    ''' Streams an XER file into a dictionary of data frames (see read_xer).'''
     
     import io
-    # Reading XER file
+    import operator
+    
+    # PROJECT is always read as the data date comes from it
+    if tables is not None:
+        tables = set(tables) | set(['PROJECT'])
+    if columns is None:
+        columns = {}
+    
+    dict = {}
+    
+    # Streaming XER file and building only requested tables
+    tbl_name = None
+    lst_rows = None
     with io.open(file_name, "r", encoding="ISO-8859-1") as f:
-        lstLines = list(f)
+        for line in f:
+            if line.startswith('%R'):
+                if lst_rows is not None:
+                    values = line.rstrip('\r\n').split('\t')
+                    if len(values) < num_fields:
+                        values.extend([''] * (num_fields - len(values)))
+                    lst_rows.append(get_values(values))
+            elif line.startswith('%T'):
+                if tbl_name is not None and lst_rows is not None:
+                    dict[tbl_name] = pd.DataFrame.from_records(data = lst_rows, columns = h)
+                tbl_name = line.rstrip('\r\n').split('\t')[1].strip()
+                lst_rows = None
+            elif line.startswith('%F'):
+                if tables is not None and tbl_name not in tables:
+                    continue
+                lst_fields = line.rstrip('\r\n').split('\t')
+                num_fields = len(lst_fields)
+                
+                # Projecting requested columns (positions include the leading %R marker)
+                h = [x for x in lst_fields[1:] if tbl_name not in columns or x in columns[tbl_name] or (tbl_name == 'PROJECT' and x == 'last_recalc_date')]
+                idx = [lst_fields.index(x) for x in h]
+                if len(idx) > 1:
+                    get_values = operator.itemgetter(*idx)
+                else:
+                    get_values = lambda values, idx = idx: tuple(values[i] for i in idx)
+                lst_rows = []
+            elif line.startswith('%E'):
+                break
+    
+    if tbl_name is not None and lst_rows is not None:
+        dict[tbl_name] = pd.DataFrame.from_records(data = lst_rows, columns = h)
+
+    if convert_types:
+        for tbl_name in dict:
+            convert_xer_types(dict[tbl_name])
+    
+    return dict, pd.to_datetime(dict['PROJECT']['last_recalc_date'])
+   
+    
+def _period_codes(dates, freq):
+    ''' Converts a datetime64 array into integer period numbers (months, Monday-based weeks or days since 1970-01-01).'''
+    if freq == 'M':
+        return dates.astype('datetime64[M]').astype(np.int64)
+    days = dates.astype('datetime64[D]').astype(np.int64)
+    if freq == 'W':
+        # 1970-01-05 is the first Monday after the epoch
+        return (days - 4) // 7
+    return days
 
-    # Getting List of Tables
-    lstTables = [(x, lstLines.index(x)) for x in lstLines if x.find('%T') != -1]
-    lstTables.append(("%E",len(lstLines) - 1))
+def _period_starts(codes, freq):
+    ''' Converts integer period numbers back into datetime64 period start dates.'''
+    if freq == 'M':
+        return codes.astype('datetime64[M]').astype('datetime64[ns]')
+    if freq == 'W':
+        codes = codes * 7 + 4
+    return codes.astype('datetime64[D]').astype('datetime64[ns]')
 
-    dict = {}
+def _period_labels(codes, freq):
+    ''' Formats integer period numbers as interval labels (YYYY-MM for months, YYYY-MM-DD of the first day for weeks and days).'''
+    if freq == 'M':
+        return [str(x) for x in codes.astype('datetime64[M]')]
+    return [str(x) for x in _period_starts(codes, freq).astype('datetime64[D]')]
+
+# P6 calendar data nodes: days of week (1 = Sunday), exceptions (d = days since 1899-12-30) and working periods (s = start, f = finish)
+_CLNDR_DAY_PATTERN = re.compile(r'\(0\|\|([1-7])\(\)\(')
+_CLNDR_EXCEPTION_PATTERN = re.compile(r'\(0\|\|\d+\(d\|(\d+)\)\(')
+_CLNDR_PERIOD_PATTERN = re.compile(r'([sf])\|(\d{1,2}):(\d{2})\|[sf]\|(\d{1,2}):(\d{2})')
+
+# Days from 1899-12-30 (P6 exception dates) to 1970-01-01
+_CLNDR_EPOCH_OFFSET = 25569
+
+_DAY_NS = 24 * 3600 * 10 ** 9
+
+def _parse_working_minutes(text):
+    ''' Returns a boolean array over the 1440 minutes of a day flagging the working periods of a calendar data node.'''
+    minutes = np.zeros(1440, dtype = bool)
+    for m in _CLNDR_PERIOD_PATTERN.finditer(text):
+        start, finish = int(m.group(2)) * 60 + int(m.group(3)), int(m.group(4)) * 60 + int(m.group(5))
+        if m.group(1) == 'f':
+            start, finish = finish, start
+        if finish <= start:
+            # Period running past midnight (or ending at 00:00)
+            minutes[start:] = True
+            start = 0
+        minutes[start:finish] = True
+    return minutes
+
+def _split_calendar_nodes(pattern, text):
+    ''' Splits calendar data into (key, text) pairs at the nodes matching pattern.'''
+    lst_matches = list(pattern.finditer(text))
+    lst_ends = [x.start() for x in lst_matches[1:]] + [len(text)]
+    return [(m.group(1), text[m.end():end]) for m, end in zip(lst_matches, lst_ends)]
+
+def _calendar_key(value):
+    ''' Converts a calendar id (text, integer or float) into a text key.'''
+    if isinstance(value, (float, np.floating)):
+        return '%d' % value
+    return str(value).strip()
+
+class WorkingCalendars(object):
+    '''
+    Working-time lookup tables of an XER CALENDAR table for calendar-aware time phasing.
     
-    for tbl in lstTables:
-        if tbl[0] != "%E":
-            i = [lstTables.index(x) for x in lstTables if x[0] == tbl[0]][0]
-            h = lstLines[lstTables[i][1] + 1].split('\t')[1:]
+    Each clndr_data is parsed once into working hours per day of week and per exception date. Cumulative working hours at day (D) or hour (H) resolution are built
+    on first use and cached per calendar, so the working time between two instants is two table lookups and a subtraction.
+    Working days are working hours divided by the calendar's day_hr_cnt. Activities are assigned calendars by calendar_field_name (TASK.clndr_id);
+    unknown or blank calendars fall back to the default calendar and calendars without working periods are measured in elapsed time.
+    
+    Within an hour (H) the working time is spread evenly. At day (D) resolution whole days are counted and instants are rounded to the nearest midnight
+    (e.g. Mon 08:00 to Fri 17:00 counts Monday to Friday), which is approximate for activities that start or finish mid-day.
+    '''
+    
+    def __init__(self, df_calendars, resolution='H', calendar_field_name='clndr_id'):
+        self.resolution = resolution
+        self.calendar_field_name = calendar_field_name
+        self.slots = 24 if resolution == 'H' else 1
+        self.calendars = {}
+        self._patterns = {}
+        self._tables = {}
+        
+        lst_hours_per_day = pd.to_numeric(df_calendars['day_hr_cnt'], errors = 'coerce') if 'day_hr_cnt' in df_calendars else [np.nan] * len(df_calendars)
+        for clndr_id, clndr_data, hours_per_day in zip(df_calendars['clndr_id'], df_calendars['clndr_data'], lst_hours_per_day):
+            clndr_data = clndr_data if pd.notnull(clndr_data) else ''
             
-            lstAsText = lstLines[lstTables[i][1] + 2:lstTables[i + 1][1]]
-            lst = [x.split('\t')[1:] for x in lstAsText]
+            # Calendars with the same data share their lookup table
+            if clndr_data not in self._patterns:
+                self._patterns[clndr_data] = self._parse(clndr_data)
+            week_hours, exception_days, exception_hours, elapsed = self._patterns[clndr_data]
+            if elapsed or not hours_per_day > 0:
+                hours_per_day = week_hours.sum(axis = 1).max()
+            self.calendars[_calendar_key(clndr_id)] = (clndr_data, float(hours_per_day))
+        
+        # Default calendar of activities without a known calendar
+        if 'default_flag' in df_calendars and (df_calendars['default_flag'] == 'Y').any():
+            self.default_calendar_id = _calendar_key(df_calendars['clndr_id'][df_calendars['default_flag'] == 'Y'].iloc[0])
+        else:
+            self.default_calendar_id = _calendar_key(df_calendars['clndr_id'].iloc[0])
+    
+    def _parse(self, clndr_data):
+        ''' Parses calendar data into working hours per slot of each day of week (Thursday first, as 1970-01-01) and of each exception day, and whether it is elapsed time.'''
+        exceptions_start = clndr_data.find('Exceptions()')
+        if exceptions_start < 0:
+            exceptions_start = len(clndr_data)
+        
+        week_minutes = np.zeros((7, 1440), dtype = bool)
+        for day, day_text in _split_calendar_nodes(_CLNDR_DAY_PATTERN, clndr_data[:exceptions_start]):
+            week_minutes[(int(day) + 2) % 7] = _parse_working_minutes(day_text)
+        
+        if not week_minutes.any():
+            # No working periods: elapsed time
+            return np.full((7, self.slots), 24.0 / self.slots), np.zeros(0, dtype = np.int64), np.zeros((0, self.slots)), True
+        
+        lst_exceptions = _split_calendar_nodes(_CLNDR_EXCEPTION_PATTERN, clndr_data[exceptions_start:])
+        exception_days = np.array([int(x[0]) - _CLNDR_EPOCH_OFFSET for x in lst_exceptions], dtype = np.int64)
+        exception_minutes = np.array([_parse_working_minutes(x[1]) for x in lst_exceptions], dtype = bool).reshape(-1, 1440)
+        
+        # Working hours per slot
+        to_hours = lambda minutes: minutes.reshape(len(minutes), self.slots, 1440 // self.slots).sum(axis = 2) / 60.0
+        return to_hours(week_minutes), exception_days, to_hours(exception_minutes), False
+    
+    def _get_table(self, clndr_data, first_day, last_day):
+        ''' Returns the first day and cumulative working hours per slot of a calendar, covering first_day to last_day (days since 1970-01-01).'''
+        if clndr_data in self._tables:
+            origin, cumulative = self._tables[clndr_data]
+            end = origin + (len(cumulative) - 1) // self.slots
+            if first_day >= origin and last_day < end:
+                return origin, cumulative
+            first_day, last_day = min(first_day, origin), max(last_day, end - 1)
+        
+        # Building a year wider than needed to limit rebuilds
+        origin = first_day - 366
+        days = np.arange(origin, last_day + 367)
+        week_hours, exception_days, exception_hours, elapsed = self._patterns[clndr_data]
+        hours = week_hours[days % 7]
+        in_range = (exception_days >= origin) & (exception_days < origin + len(days))
+        hours[exception_days[in_range] - origin] = exception_hours[in_range]
+        cumulative = np.concatenate([[0.0], np.cumsum(hours.ravel())])
+        
+        self._tables[clndr_data] = origin, cumulative
+        return origin, cumulative
+    
+    def _lookup(self, origin, cumulative, instants):
+        ''' Returns the cumulative working hours at instants (nanoseconds since 1970-01-01), interpolating within slots.'''
+        position = (instants - origin * _DAY_NS) / float(_DAY_NS // self.slots)
+        if self.slots == 1:
+            # Whole days: counting from the nearest midnight
+            position = np.floor(position + 0.5)
+        slot = np.minimum(np.floor(position).astype(np.int64), len(cumulative) - 2)
+        return cumulative[slot] + (position - slot) * (cumulative[slot + 1] - cumulative[slot])
+    
+    def _inverse_lookup(self, origin, cumulative, hours):
+        ''' Returns the last instants (nanoseconds since 1970-01-01) at which the cumulative working hours reach hours.'''
+        end = np.minimum(np.searchsorted(cumulative, hours, side = 'right'), len(cumulative) - 1)
+        slot = np.maximum(end - 1, 0)
+        width = cumulative[end] - cumulative[slot]
+        fraction = np.clip(np.where(width > 0, (hours - cumulative[slot]) / np.where(width > 0, width, 1.0), 0.0), 0.0, 1.0)
+        if self.slots == 1:
+            fraction = np.floor(fraction + 0.5)
+        return origin * _DAY_NS + np.round((slot + fraction) * (_DAY_NS // self.slots)).astype(np.int64)
+    
+    def get_working_hours(self, calendar_ids, starts, finishes, in_days=False):
+        ''' Returns the working hours (working days if in_days) between starts and finishes on each calendar (NaN where a date is blank).'''
+        starts = np.asarray(starts, dtype = 'datetime64[ns]')
+        finishes = np.asarray(finishes, dtype = 'datetime64[ns]')
+        valid = ~(pd.isnull(starts) | pd.isnull(finishes))
+        starts = starts.astype(np.int64)
+        finishes = finishes.astype(np.int64)
+        
+        hours = np.full(len(starts), np.nan)
+        codes, uniques = pd.factorize(np.asarray(calendar_ids))
+        for i in range(-1, len(uniques)):
+            mask = (codes == i) & valid
+            if not mask.any():
+                continue
+            clndr_data, hours_per_day = self.calendars.get(_calendar_key(uniques[i]) if i >= 0 else None, self.calendars[self.default_calendar_id])
+            origin, cumulative = self._get_table(clndr_data, min(starts[mask].min(), finishes[mask].min()) // _DAY_NS,
+                                                 max(starts[mask].max(), finishes[mask].max()) // _DAY_NS)
+            hours[mask] = self._lookup(origin, cumulative, finishes[mask]) - self._lookup(origin, cumulative, starts[mask])
+            if in_days:
+                hours[mask] /= hours_per_day
+        return hours
+    
+    def get_fingerprint(self, calendar_id):
+        ''' Returns a digest of the working time of a calendar (the default calendar if calendar_id is unknown or blank), which changes with its data.'''
+        clndr_data, hours_per_day = self.calendars.get(_calendar_key(calendar_id) if calendar_id is not None else None, self.calendars[self.default_calendar_id])
+        return hashlib.md5(('%s|%r|%s' % (self.resolution, hours_per_day, clndr_data)).encode('utf-8')).hexdigest()
+    
+    def get_working_days(self, calendar_ids, starts, finishes):
+        ''' Returns the working days between starts and finishes on each calendar (NaN where a date is blank).'''
+        return self.get_working_hours(calendar_ids, starts, finishes, in_days = True)
+    
+    def subtract_working_days(self, calendar_ids, finishes, days):
+        ''' Returns the instants days working days before finishes on each calendar (NaT where a date or duration is blank).'''
+        finishes = np.asarray(finishes, dtype = 'datetime64[ns]')
+        days = np.asarray(days, dtype = float)
+        valid = ~(pd.isnull(finishes) | np.isnan(days))
+        finishes = finishes.astype(np.int64)
+        
+        starts = np.full(len(finishes), np.iinfo(np.int64).min, dtype = np.int64)
+        codes, uniques = pd.factorize(np.asarray(calendar_ids))
+        for i in range(-1, len(uniques)):
+            mask = (codes == i) & valid
+            if not mask.any():
+                continue
+            clndr_data, hours_per_day = self.calendars.get(_calendar_key(uniques[i]) if i >= 0 else None, self.calendars[self.default_calendar_id])
             
-            df = pd.DataFrame.from_records(data = lst, columns = h)
+            # Widening the table back until it covers the longest duration (up to a century)
+            span = 0
+            while True:
+                origin, cumulative = self._get_table(clndr_data, finishes[mask].min() // _DAY_NS - span, finishes[mask].max() // _DAY_NS)
+                targets = self._lookup(origin, cumulative, finishes[mask]) - days[mask] * hours_per_day
+                if targets.min() >= 0 or span > 36600:
+                    break
+                span = max(2 * span, 366)
+            starts[mask] = self._inverse_lookup(origin, cumulative, targets)
+        return starts.view('datetime64[ns]')
 
-            dict["".join(tbl[0].split()[1])] = df
+def _get_durations(starts, finishes, calendar_ids=None, calendars=None):
+    ''' Returns finishes - starts as timedelta64, in working days of each activity's calendar if calendars is given.'''
+    if calendars is None:
+        return finishes - starts
+    return pd.to_timedelta(calendars.get_working_days(calendar_ids, starts, finishes), unit = 'D').values
 
-    return dict, pd.to_datetime(dict['PROJECT']['last_recalc_date'])
-   
+class TimePhased(object):
+    '''
+    Sparse activity x period durations (in days, working days if phased on calendars) in coordinate (COO) form, kept apart from task attributes.
     
-def time_phase_monthly(df, id_field_name, start_field_name, finish_field_name):
-    ''' Applies time-phasing operation on a data frame.'''
+    index holds the data frame labels and task_ids the ids of the rows, periods holds the period labels of the columns and rows, columns and values hold one entry per activity and period.
+    '''
+    
+    def __init__(self, index, task_ids, id_field_name, period_codes, freq, rows, columns, values):
+        self.index = index
+        self.task_ids = task_ids
+        self.id_field_name = id_field_name
+        self.period_codes = period_codes
+        self.periods = pd.Index(_period_labels(period_codes, freq))
+        self.freq = freq
+        self.rows = rows
+        self.columns = columns
+        self.values = values
+    
+    @property
+    def shape(self):
+        return len(self.index), len(self.periods)
+    
+    def to_long(self):
+        ''' Returns a long data frame with one (task id, interval, duration) row per activity and period.'''
+        return pd.DataFrame({self.id_field_name: self.task_ids[self.rows], 'interval': self.periods.values[self.columns], 'duration': self.values},
+                            columns = [self.id_field_name, 'interval', 'duration'])
+    
+    def to_dense(self):
+        ''' Returns the activity x period matrix as a data frame indexed like the time-phased data frame (NaN where an activity has no duration in a period).'''
+        matrix = np.full(self.shape, np.nan)
+        matrix[self.rows, self.columns] = self.values
+        return pd.DataFrame(matrix, index = self.index, columns = self.periods)
+    
+    def to_wide(self, df):
+        ''' Returns the wide form returned by time_phase: the rows of df (the data frame that was time-phased) followed by one column per period.'''
+        # Selecting rows only if some were left out (concat copies df)
+        if len(self.index) != len(df) or not self.index.equals(df.index):
+            df = df.loc[self.index]
+        return pd.concat([df, self.to_dense()], axis = 1)
+    
+    def to_scipy(self):
+        ''' Returns the matrix as a scipy.sparse CSR matrix (requires scipy).'''
+        from scipy import sparse
+        return sparse.coo_matrix((self.values, (self.rows, self.columns)), shape = self.shape).tocsr()
+    
+    def multiply(self, factors):
+        ''' Returns a new TimePhased with every activity's durations multiplied by its factor (one factor per row).'''
+        return TimePhased(self.index, self.task_ids, self.id_field_name, self.period_codes, self.freq, self.rows, self.columns, self.values * np.asarray(factors, dtype = np.float64)[self.rows])
+    
+    def select(self, mask):
+        ''' Returns a new TimePhased with the rows where mask is True, dropping periods left without values.'''
+        mask = np.asarray(mask, dtype = bool)
+        new_rows = np.cumsum(mask) - 1
+        keep = mask[self.rows]
+        used = np.bincount(self.columns[keep], minlength = len(self.periods)) > 0
+        columns = (np.cumsum(used) - 1)[self.columns[keep]]
+        return TimePhased(self.index[mask], self.task_ids[mask], self.id_field_name, self.period_codes[used], self.freq, new_rows[self.rows[keep]].astype(np.int32), columns.astype(np.int32), self.values[keep])
+    
+    def take(self, positions):
+        ''' Returns a new TimePhased with the rows at positions (in that order), dropping periods left without values.'''
+        positions = np.asarray(positions, dtype = np.int64)
+        if len(positions) == len(self.index) and (positions == np.arange(len(positions))).all():
+            return self
+        
+        # Entries of each row are contiguous once sorted by row
+        order = np.argsort(self.rows, kind = 'mergesort') if (np.diff(self.rows) < 0).any() else np.arange(len(self.rows))
+        counts = np.bincount(self.rows, minlength = len(self.index))
+        lengths = counts[positions]
+        offsets = np.cumsum(lengths) - lengths
+        entries = order[np.repeat(np.cumsum(counts)[positions] - counts[positions] - offsets, lengths) + np.arange(lengths.sum())]
+        
+        used = np.bincount(self.columns[entries], minlength = len(self.periods)) > 0
+        columns = (np.cumsum(used) - 1)[self.columns[entries]]
+        return TimePhased(self.index[positions], self.task_ids[positions], self.id_field_name, self.period_codes[used], self.freq,
+                          np.repeat(np.arange(len(positions), dtype = np.int32), lengths), columns.astype(np.int32), self.values[entries])
+    
+    def sum_by_period(self):
+        ''' Returns total durations per period.'''
+        return pd.Series(np.bincount(self.columns, weights = self.values, minlength = len(self.periods)), index = self.periods)
+
+def time_phase_sparse(df, id_field_name, start_field_name, finish_field_name, freq='M', calendars=None):
+    ''' Applies time-phasing operation on a data frame for monthly (M), weekly (W) or daily (D) periods.
+    
+    Returns a sparse TimePhased of the activities and a boolean series flagging activities with blank dates or zero duration.
+    Activities with blank dates are left out of the TimePhased.
+    Durations are elapsed days, or working days of each activity's calendar if calendars (a WorkingCalendars) is given.
+    '''
     
     df.loc[:,start_field_name] = pd.to_datetime(df.loc[:,start_field_name])
     df.loc[:,finish_field_name] = pd.to_datetime(df.loc[:,finish_field_name])
+    
+    ASD = df[start_field_name].values.astype('datetime64[ns]')
+    AFD = df[finish_field_name].values.astype('datetime64[ns]')
+    
+    # Flagging blank and zero duration activities
+    blank = pd.isnull(ASD) | pd.isnull(AFD)
+    sr_invalid = pd.Series(blank | (AFD <= ASD), index = df.index)
+    
+    time_phased = _time_phase_periods(df.index[~blank], df[id_field_name].values[~blank], id_field_name, ASD[~blank], AFD[~blank],
+                                      df[calendars.calendar_field_name].values[~blank] if calendars is not None else None, freq, calendars)
+    
+    return time_phased, sr_invalid
 
-    lstTimePhased = []
+def _time_phase_periods(index, task_ids, id_field_name, ASD, AFD, calendar_ids, freq, calendars):
+    ''' Returns the TimePhased of activities with non-blank start and finish dates (datetime64 arrays).'''
+    
+    # Splitting every activity into the periods from its start period to its finish period
+    start_codes = _period_codes(ASD, freq)
+    num_periods = np.maximum(_period_codes(AFD, freq) - start_codes + 1, 1)
+    rows = np.repeat(np.arange(len(ASD), dtype = np.int32), num_periods)
+    offsets = np.repeat(np.cumsum(num_periods) - num_periods, num_periods)
+    codes = np.repeat(start_codes, num_periods) + np.arange(len(rows)) - offsets
+    
+    # Overlap of each period with its activity
+    ISD = np.maximum(_period_starts(codes, freq), ASD[rows])
+    IFD = np.minimum(_period_starts(codes + 1, freq), AFD[rows])
+    if calendars is None:
+        durations = (IFD - ISD) / np.timedelta64(1, 'D')
+    else:
+        durations = calendars.get_working_days(calendar_ids[rows], ISD, IFD)
+    
+    period_codes, columns = np.unique(codes, return_inverse = True)
+    
+    return TimePhased(index, task_ids, id_field_name, period_codes, freq, rows, columns.astype(np.int32), durations)
 
-    for index, row in df.iterrows():
-        if (pd.isnull(row[start_field_name]) == True | pd.isnull(row[finish_field_name]) == True):
-            print row[id_field_name], ' has blank Start or Finish date(s).'
-            continue
-            
-        ASD = row[start_field_name]
-        AFD = row[finish_field_name]
-        
-        StartPointer = datetime.datetime(year = ASD.year, month = ASD.month, day = 1, hour = 0, minute = 0, second = 0)   
-        FinishPointer = datetime.datetime(year = AFD.year, month = AFD.month , day = 1, hour = 0, minute = 0, second = 0) + relativedelta(months = 1)
-
-        ISD = StartPointer
-        IFD = StartPointer + relativedelta(months = 1)
-
-        while True:        
-            if (min(IFD, AFD) - max(ISD,ASD)).total_seconds > 0.0:
-                lstTimePhased.append([index, str(ISD.year) + "-" + str(ISD.month).rjust(2, '0'), (min(IFD, AFD) - max(ISD, ASD)).total_seconds()/(3600 * 24)])
-                ISD = IFD
-                IFD = IFD + relativedelta(months = 1)
-            else:
-                print row[id_field_name], ' has zero duration.'
-                break
+def time_phase(df, id_field_name, start_field_name, finish_field_name, freq='M', calendars=None):
+    ''' Applies time-phasing operation on a data frame for monthly (M), weekly (W) or daily (D) periods.
+    
+    Returns the data frame with one duration column (in days, working days if calendars is given) per period and a boolean series flagging activities with blank dates or zero duration.
+    Activities with blank dates are left out of the time-phased data frame.
+    '''
+    
+    time_phased, sr_invalid = time_phase_sparse(df, id_field_name, start_field_name, finish_field_name, freq, calendars)
+    
+    return time_phased.to_wide(df), sr_invalid
+    
+def time_phase_monthly(df, id_field_name, start_field_name, finish_field_name):
+    ''' Applies time-phasing operation on a data frame.'''
+    
+    return time_phase(df, id_field_name, start_field_name, finish_field_name, 'M')[0]
 
-            if IFD > FinishPointer: break
+def time_phase_incremental(df, id_field_name, start_field_name, finish_field_name, previous_state=None, freq='M', calendars=None):
+    '''
+    Same as time_phase but only re-phases activities whose start, finish or calendar changed since previous_state, splicing previous time-phased rows for the others.
+    Returns the time-phased data frame, the invalid activities series and the state to pass with the next update.
+    The state holds the sparse TimePhased of the activities and their fingerprints, so an update costs in proportion to its changed activities.
+    '''
+    
+    df.loc[:,start_field_name] = pd.to_datetime(df.loc[:,start_field_name])
+    df.loc[:,finish_field_name] = pd.to_datetime(df.loc[:,finish_field_name])
+    
+    ASD = df[start_field_name].values.astype('datetime64[ns]')
+    AFD = df[finish_field_name].values.astype('datetime64[ns]')
+    
+    # Flagging blank and zero duration activities
+    blank = pd.isnull(ASD) | pd.isnull(AFD)
+    sr_invalid = pd.Series(blank | (AFD <= ASD), index = df.index)
+    
+    # Fingerprinting activities by their start, finish and calendar (by its data, so that a calendar changed under the same id re-phases its activities)
+    valid_rows = np.flatnonzero(~blank)
+    ids = df[id_field_name].values[valid_rows]
+    starts = ASD[valid_rows].astype(np.int64)
+    finishes = AFD[valid_rows].astype(np.int64)
+    if calendars is None:
+        calendar_ids = np.full(len(ids), '', dtype = object)
+    else:
+        codes, uniques = pd.factorize(df[calendars.calendar_field_name].values[valid_rows])
+        calendar_ids = np.array([calendars.get_fingerprint(x) for x in uniques] + [calendars.get_fingerprint(None)], dtype = object)[codes]
+    
+    # Matching activities to the previous state by position when the ids are unchanged, else by id (the first row of an id if it repeats)
+    positions = np.full(len(ids), -1, dtype = np.int64)
+    in_order = False
+    if previous_state is not None:
+        previous_ids = previous_state['ids']
+        in_order = np.array_equal(previous_ids, ids)
+        if in_order:
+            positions = np.arange(len(ids))
+        else:
+            index = pd.Index(previous_ids)
+            first = ~index.duplicated()
+            positions = index[first].get_indexer(ids)
+            positions = np.where(positions >= 0, np.flatnonzero(first)[positions], -1)
+    found = positions >= 0
+    unchanged = np.zeros(len(ids), dtype = bool)
+    if found.any():
+        unchanged[found] = ((previous_state['start_date'][positions[found]] == starts[found]) & (previous_state['finish_date'][positions[found]] == finishes[found])
+                            & (previous_state['calendar_id'][positions[found]] == calendar_ids[found]))
+    
+    # Time-Phasing changed activities only
+    changed_rows = valid_rows[~unchanged]
+    time_phased = _time_phase_periods(df.index[changed_rows], ids[~unchanged], id_field_name, ASD[changed_rows], AFD[changed_rows],
+                                      df[calendars.calendar_field_name].values[changed_rows] if calendars is not None else None, freq, calendars)
+    
+    # Splicing previous rows of unchanged activities
+    if unchanged.any():
+        if in_order:
+            unchanged_time_phased = previous_state['time_phased'].select(unchanged)
+        else:
+            unchanged_time_phased = previous_state['time_phased'].take(positions[unchanged])
+        period_codes = np.union1d(unchanged_time_phased.period_codes, time_phased.period_codes)
+        unchanged_entry_rows = np.flatnonzero(unchanged)[unchanged_time_phased.rows]
+        changed_entry_rows = np.flatnonzero(~unchanged)[time_phased.rows]
+        
+        # Inserting entries of changed activities between entries of unchanged activities in row order
+        insert_at = np.searchsorted(unchanged_entry_rows, changed_entry_rows)
+        rows = np.insert(unchanged_entry_rows, insert_at, changed_entry_rows)
+        columns = np.insert(np.searchsorted(period_codes, unchanged_time_phased.period_codes)[unchanged_time_phased.columns], insert_at,
+                            np.searchsorted(period_codes, time_phased.period_codes)[time_phased.columns])
+        values = np.insert(unchanged_time_phased.values, insert_at, time_phased.values)
+        time_phased = TimePhased(df.index[valid_rows], ids, id_field_name, period_codes, freq, rows.astype(np.int32), columns.astype(np.int32), values)
+    
+    state = {'time_phased': time_phased, 'ids': ids, 'start_date': starts, 'finish_date': finishes, 'calendar_id': calendar_ids}
+    
+    return time_phased.to_wide(df), sr_invalid, state
 
-    dfTimePhased = pd.DataFrame.from_records(columns = [id_field_name,'interval','duration'], data = lstTimePhased)
-    df = pd.concat([df,dfTimePhased.pivot(index=id_field_name, columns = 'interval', values='duration')], axis = 1, join='inner')   
+def _time_phase_pass(incremental_state, pass_name, df, id_field_name, start_field_name, finish_field_name, instrumentation, calendars):
+    '''
+    Time-phases a data frame monthly, incrementally against incremental_state[pass_name] if an incremental state dictionary is given.
+    Activities with blank dates or zero duration are reported to instrumentation.
+    '''
+    stage = 'time_phase:' + pass_name
+    with instrumentation.stage(stage, len(df)) as record:
+        if incremental_state is None:
+            df_time_phased, sr_invalid = time_phase(df, id_field_name, start_field_name, finish_field_name, 'M', calendars)
+        else:
+            df_time_phased, sr_invalid, incremental_state[pass_name] = time_phase_incremental(df, id_field_name, start_field_name, finish_field_name, incremental_state.get(pass_name), 'M', calendars)
+        record['rows_out'] = len(df_time_phased)
     
-    return df
+    if instrumentation.enabled and sr_invalid.any():
+        blank = (df[start_field_name].isnull() | df[finish_field_name].isnull()).values
+        if blank.any():
+            instrumentation.add_issue(stage, 'blank_start_or_finish', df[id_field_name].values[blank])
+        if (sr_invalid.values & ~blank).any():
+            instrumentation.add_issue(stage, 'zero_duration', df[id_field_name].values[sr_invalid.values & ~blank])
+    
+    return df_time_phased
 	
 def find_children(return_obj, lookup_value, df, parent_column_name, id_column_name):
     ''' Finds all children in a hierarchical (self-related) data frame.'''
@@ -84,6 +722,94 @@ def get_hierarchical_paths(return_list, lookup_value, parent_short_name, df, par
         return_list.append({'id':item[id_column_name], 'path':parent_short_name + '.' + item[field_name_to_aggregate]})
         get_hierarchical_paths(return_list, item[id_column_name], parent_short_name + '.' + item[field_name_to_aggregate], df, parent_column_name, id_column_name, field_name_to_aggregate)
         
+class HierarchyIndex(object):
+    ''' Index of a hierarchical (self-related) data frame built once for repeated subtree and path lookups.
+    
+    nodes is a data frame indexed by node id with parent, path, depth and Euler-tour pre_order/post_order numbers, and children maps each node id to the list of its child ids.
+    A node y is in the subtree of x if pre_order[x] <= pre_order[y] < post_order[x].
+    '''
+    
+    def __init__(self, df, parent_column_name, id_column_name, field_name_to_aggregate, root_ids=None, include_root_in_path=True):
+        ids = df[id_column_name].tolist()
+        parents = df[parent_column_name].tolist()
+        names = dict(zip(ids, df[field_name_to_aggregate].tolist()))
+        
+        # Building parent -> children adjacency
+        self.children = {}
+        for node_id, parent_id in zip(ids, parents):
+            self.children.setdefault(parent_id, []).append(node_id)
+        
+        # Roots are the given nodes or the ones whose parent is not in the data frame
+        if root_ids is None:
+            set_ids = set(ids)
+            root_ids = [node_id for node_id, parent_id in zip(ids, parents) if parent_id not in set_ids]
+        
+        # Walking the trees once (iteratively) to number nodes and build paths
+        parent = {}
+        path = {}
+        depth = {}
+        pre_order = {}
+        post_order = {}
+        counter = 0
+        for root_id in root_ids:
+            if root_id in pre_order:
+                continue
+            parent[root_id] = None
+            path[root_id] = names[root_id] if include_root_in_path else None
+            depth[root_id] = 0
+            stack = [(root_id, False)]
+            while stack:
+                node_id, visited = stack.pop()
+                if visited:
+                    post_order[node_id] = counter
+                    counter += 1
+                    continue
+                pre_order[node_id] = counter
+                counter += 1
+                stack.append((node_id, True))
+                for child_id in reversed(self.children.get(node_id, [])):
+                    if child_id in pre_order:
+                        continue
+                    parent[child_id] = node_id
+                    path[child_id] = names[child_id] if path[node_id] is None else path[node_id] + '.' + names[child_id]
+                    depth[child_id] = depth[node_id] + 1
+                    stack.append((child_id, False))
+        
+        self.nodes = pd.DataFrame({'parent': parent, 'path': path, 'depth': depth, 'pre_order': pre_order, 'post_order': post_order},
+                                  columns = ['parent', 'path', 'depth', 'pre_order', 'post_order'])
+        self.size = counter
+    
+    def get_ids_by_paths(self, lst_paths):
+        ''' Returns the ids of the nodes with the given paths.'''
+        return self.nodes.index[self.nodes['path'].isin(lst_paths)]
+    
+    def get_subtree_mask(self, values, lst_inclusion_ids, lst_exclusion_ids=None):
+        ''' Returns a boolean array that is True for values under (or equal to) an included node and not under an excluded node.'''
+        
+        # Marking Euler-tour ranges covered by inclusions and exclusions
+        def coverage(lst_ids):
+            df_ranges = self.nodes.loc[self.nodes.index.isin(lst_ids), ['pre_order', 'post_order']]
+            counts = np.zeros(self.size + 1, dtype = np.int64)
+            np.add.at(counts, df_ranges['pre_order'].values, 1)
+            np.add.at(counts, df_ranges['post_order'].values, -1)
+            return np.cumsum(counts)[:-1] > 0
+        
+        if self.size == 0:
+            return np.zeros(len(values), dtype = bool)
+        
+        covered = coverage(lst_inclusion_ids)
+        if lst_exclusion_ids is not None:
+            covered &= ~coverage(lst_exclusion_ids)
+        
+        # Testing each value's pre-order number against the covered ranges
+        positions = self.nodes.index.get_indexer(values)
+        pre = self.nodes['pre_order'].values[positions]
+        return (positions != -1) & covered[pre]
+    
+    def get_subtree_ids(self, lst_ids):
+        ''' Returns the ids of the given nodes and all of their descendants.'''
+        return self.nodes.index[self.get_subtree_mask(self.nodes.index, lst_ids)]
+
 def fill_date_range_gaps(df):
     rng = pd.period_range(df.index.min(), df.index.max(), freq='M')
     df_ranges = pd.DataFrame(data=rng.to_series().astype(np.string_).values, index = rng, columns=['period_range'])
@@ -91,59 +817,45 @@ def fill_date_range_gaps(df):
     del df_return['period_range']
     return df_return
 
-def get_tasks_by_wbs_paths(lst_wbs_inclusions, lst_wbs_exclusions, df_xer):
+def build_wbs_index(df_xer):
+    ''' Builds a HierarchyIndex over PROJWBS with paths relative to each project node.'''
     df_wbs = df_xer['PROJWBS']
-    
-    # Separating Project Nodes from WBS Nodes
-    lst_project_node_wbs_ids = df_wbs[df_wbs['proj_node_flag'] == 'Y']['wbs_id']
-    #df_wbs_nodes = df_wbs[~df_wbs['wbs_id'].isin(lst_project_node_wbs_ids)]
+    lst_project_node_wbs_ids = df_wbs[df_wbs['proj_node_flag'] == 'Y']['wbs_id'].tolist()
+    return HierarchyIndex(df_wbs, 'parent_wbs_id', 'wbs_id', 'wbs_short_name', root_ids = lst_project_node_wbs_ids, include_root_in_path = False)
 
-    df_wbs_temp = pd.DataFrame()
-    for proj in lst_project_node_wbs_ids:
-        # Adding path to wbs data frame
-        lst_wbs_path_project=[]
-        get_hierarchical_paths(lst_wbs_path_project, proj, proj, df_wbs, 'parent_wbs_id', 'wbs_id', 'wbs_short_name')
-        df_wbs_temp = df_wbs_temp.append(pd.DataFrame(lst_wbs_path_project))
+def get_task_wbs_paths(df_xer, wbs_index=None):
+    ''' Returns task ids with the path of their WBS node (relative to the project node).'''
+    if wbs_index is None:
+        wbs_index = build_wbs_index(df_xer)
+    df_tasks = df_xer['TASK'][['task_id', 'wbs_id']]
+    return df_tasks.merge(wbs_index.nodes[['path']], left_on = 'wbs_id', right_index = True, how = 'left')[['task_id', 'path']]
 
-    df_wbs = df_wbs.merge(df_wbs_temp, left_on='wbs_id', right_on='id', how='left')
-    df_wbs['path'] = df_wbs['path'].str[len(proj) + 1:]
-    del df_wbs['id']
-    
-    # Filtering wbs includions
-    df_wbs_included = df_wbs[df_wbs['path'].isin(lst_wbs_inclusions)]
-    
-    lst_wbs_id_included_all = []
-    # Finding all WBS items under filtered WBSs
-    for wbs_id in df_wbs_included['wbs_id']:
-        lst_wbs_ids=[]
-        find_children(lst_wbs_ids, wbs_id, df_wbs, 'parent_wbs_id', 'wbs_id')
-        lst_wbs_id_included_all.extend(lst_wbs_ids)
-    
-    # Adding includions themselves
-    lst_wbs_id_included_all.extend(df_wbs[df_wbs['path'].isin(lst_wbs_inclusions)]['wbs_id'])
-    
-    # Filtering wbs items for all children
-    #df_wbs_included_all = df_wbs[(df_wbs['wbs_id'].isin(lst_wbs_id_included_all))]
-    
-    # Filtering Exclusions
-    df_wbs_excluded = df_wbs[df_wbs['path'].isin(lst_wbs_exclusions)]
-    
-    lst_wbs_id_excluded_all = []
-    # Finding all WBS items under filtered WBSs
-    for wbs_id in df_wbs_excluded['wbs_id']:
-        lst_wbs_ids=[]
-        find_children(lst_wbs_ids, wbs_id, df_wbs, 'parent_wbs_id', 'wbs_id')
-        lst_wbs_id_excluded_all.extend(lst_wbs_ids)
+def get_tasks_by_wbs_paths(lst_wbs_inclusions, lst_wbs_exclusions, df_xer, wbs_index=None, instrumentation=None):
+    ''' Returns tasks under the included WBS paths (and their children) that are not under the excluded WBS paths.
     
-    # Adding excludions themselves
-    lst_wbs_id_excluded_all.extend(df_wbs[df_wbs['path'].isin(lst_wbs_exclusions)]['wbs_id'])
+    wbs_index may be a prebuilt result of build_wbs_index to avoid rebuilding it for every query on the same XER.
+    '''
+    if instrumentation is None:
+        instrumentation = _NULL_INSTRUMENTATION
     
-    # Filtering wbs items for all children and project nodes
-    #df_wbs_excluded_all = df_wbs[(df_wbs['wbs_id'].isin(lst_wbs_id_excluded_all))]
+    with instrumentation.stage('wbs_filter', len(df_xer['TASK'])) as record:
+        if wbs_index is None:
+            wbs_index = build_wbs_index(df_xer)
+        
+        # Finding WBS nodes of inclusions and exclusions
+        lst_wbs_id_included = wbs_index.get_ids_by_paths(lst_wbs_inclusions)
+        lst_wbs_id_excluded = wbs_index.get_ids_by_paths(lst_wbs_exclusions)
+        
+        # Finding tasks under all included and not excluded wbs items
+        df_tasks = df_xer['TASK']
+        df_tasks = df_tasks[wbs_index.get_subtree_mask(df_tasks['wbs_id'], lst_wbs_id_included, lst_wbs_id_excluded)]
+        record['rows_out'] = len(df_tasks)
     
-    # Finding tasks under all wbs items
-    df_tasks = df_xer['TASK']
-    df_tasks = df_tasks[df_tasks['wbs_id'].isin(set(lst_wbs_id_included_all) - set(lst_wbs_id_excluded_all))]
+    # Reporting paths that match no WBS node
+    if instrumentation.enabled:
+        lst_unknown_paths = sorted((set(lst_wbs_inclusions) | set(lst_wbs_exclusions)) - set(wbs_index.nodes['path']))
+        if lst_unknown_paths:
+            instrumentation.add_issue('wbs_filter', 'unknown_wbs_path', lst_unknown_paths)
     
     return df_tasks
 	
@@ -157,7 +869,11 @@ def create_added_removed_data_frame(lst_ids_1, lst_ids_2):
     df.ix[~df.index.isin(lst_ids_1) & df.index.isin(lst_ids_2), 'status'] = 'added'
     return df
 	
-def get_task_activity_code_assignments(df_xer, activity_code_type_name):
+def get_task_activity_code_assignments(df_xer, activity_code_type_name, hierarchy_index=None):
+    ''' Returns activity code assignments of an activity code type with the path of each code in its hierarchy.
+    
+    hierarchy_index may be a prebuilt HierarchyIndex over the activity codes of that type.
+    '''
     # Reading Activity Code Types
     df_activity_code_types = df_xer['ACTVTYPE'][['actv_code_type_id', 'actv_code_type']]
 
@@ -166,26 +882,13 @@ def get_task_activity_code_assignments(df_xer, activity_code_type_name):
     # Reading Activity Codes
     df_activity_codes = df_xer['ACTVCODE'][df_xer['ACTVCODE']['actv_code_type_id'] == act_code_type_id][['actv_code_id', 'actv_code_name', 'short_name', 'parent_actv_code_id']]
     
-    lst_activity_code_ids = df_activity_codes[df_activity_codes['parent_actv_code_id'] == '']['actv_code_id']
-    df_paths = pd.DataFrame()
-
     # Adding Activity Code path in hierarchy
-    for act_code_id in lst_activity_code_ids:
-        lst_activity_code_path = []
-        get_hierarchical_paths(lst_activity_code_path, act_code_id, df_activity_codes[df_activity_codes['actv_code_id'] == act_code_id]['short_name'].values[0], df_activity_codes, 'parent_actv_code_id', 'actv_code_id', 'short_name')
-        df_paths = df_paths.append(pd.DataFrame(lst_activity_code_path))
-
-    # Merging if there are hierarchies
-    if df_paths.shape[0] > 0:
-        df_activity_codes = df_activity_codes.merge(df_paths, left_on='actv_code_id', right_on='id', how='left')
-        
-    # Setting parent level paths
-    df_activity_codes.ix[df_activity_codes['parent_actv_code_id'] == '', 'path'] =  df_activity_codes.ix[df_activity_codes['parent_actv_code_id'] == '', 'short_name']
+    if hierarchy_index is None:
+        hierarchy_index = HierarchyIndex(df_activity_codes, 'parent_actv_code_id', 'actv_code_id', 'short_name')
+    df_activity_codes = df_activity_codes.merge(hierarchy_index.nodes[['path']], left_on='actv_code_id', right_index=True, how='left')
 
     # Deleting extra keys
     del df_activity_codes['parent_actv_code_id']
-    if 'id' in df_activity_codes.columns:
-        del df_activity_codes['id']
 
     # Reading Activity Code Assignments to activities
     df_activity_code_assignments = df_xer['TASKACTV'][df_xer['TASKACTV']['actv_code_type_id'] == act_code_type_id][['task_id', 'actv_code_id']]
@@ -195,34 +898,40 @@ def get_task_activity_code_assignments(df_xer, activity_code_type_name):
     
     return df_all
 
+def _to_datetime64(data_date):
+    ''' Converts a data date (scalar or the single-value series returned by read_xer) to numpy datetime64.'''
+    if not np.isscalar(data_date) and not isinstance(data_date, (datetime.datetime, np.datetime64)):
+        data_date = np.asarray(data_date).ravel()[0]
+    return pd.Timestamp(data_date).to_datetime64()
+
+def convert_date_fields(df, lst_field_names):
+    ''' Returns a copy of a data frame with the given date fields converted to datetime64 (blank values become NaT).'''
+    df = df.copy()
+    for field_name in lst_field_names:
+        df[field_name] = pd.to_datetime(df[field_name])
+    return df
+
 def adjust_p6_actualized_early_late_dates(df_schedule):
     '''
     Adjusts early and late dates for actualized activities based on planned start planned finish, actual start and finish and late start and finish dates.
     '''
-    df = df_schedule.copy()
     # Converting date fields from object to dates
-    df['early_start_date'] = df['early_start_date'].values.astype(np.datetime64)
-    df['early_end_date'] = df['early_end_date'].values.astype(np.datetime64)
-    df['late_start_date'] = df['late_start_date'].values.astype(np.datetime64)
-    df['late_end_date'] = df['late_end_date'].values.astype(np.datetime64)
-    df['target_start_date'] = df['target_start_date'].values.astype(np.datetime64)
-    df['target_end_date'] = df['target_end_date'].values.astype(np.datetime64)
-    
-    # Not Started Activities
-    # All remain the same
-    df.loc[df['status_code'] == 'TK_NotStart', 'early_start_date_adjusted'] = df.loc[df['status_code'] == 'TK_NotStart', 'early_start_date']
-    df.loc[df['status_code'] == 'TK_NotStart', 'early_end_date_adjusted'] = df.loc[df['status_code'] == 'TK_NotStart', 'early_end_date']
-    df.loc[df['status_code'] == 'TK_NotStart', 'late_start_date_adjusted'] = df.loc[df['status_code'] == 'TK_NotStart', 'late_start_date']
-    df.loc[df['status_code'] == 'TK_NotStart', 'late_end_date_adjusted'] = df.loc[df['status_code'] == 'TK_NotStart', 'late_end_date']
+    df = convert_date_fields(df_schedule, ['early_start_date', 'early_end_date', 'late_start_date', 'late_end_date', 'target_start_date', 'target_end_date'])
+    
+    not_started = (df['status_code'] == 'TK_NotStart').values
+    target_start = df['target_start_date'].values
+    target_end = df['target_end_date'].values
+    late_end = df['late_end_date'].values
     
+    # Not Started Activities: All remain the same
     # Completed and In-Progress Activities:
     # 1- Changing early start date to planned start date
-    df.loc[df['status_code'] != 'TK_NotStart', 'early_start_date_adjusted'] = df.loc[df['status_code'] != 'TK_NotStart', 'target_start_date'] 
+    df['early_start_date_adjusted'] = np.where(not_started, df['early_start_date'].values, target_start)
     # 2- Changing early finish date to planned finish date
-    df.loc[df['status_code'] != 'TK_NotStart', 'early_end_date_adjusted'] = df.loc[df['status_code'] != 'TK_NotStart', 'target_end_date']
+    df['early_end_date_adjusted'] = np.where(not_started, df['early_end_date'].values, target_end)
     # 3- Changing late start date to late end date - planned duration
-    df.loc[df['status_code'] != 'TK_NotStart', 'late_start_date_adjusted'] = df.loc[df['status_code'] != 'TK_NotStart', 'late_end_date'] - df.loc[df['status_code'] != 'TK_NotStart', 'target_end_date'] + df.loc[df['status_code'] != 'TK_NotStart', 'target_start_date']
-    df.loc[df['status_code'] != 'TK_NotStart', 'late_end_date_adjusted'] = df.loc[df['status_code'] != 'TK_NotStart', 'late_end_date'] 
+    df['late_start_date_adjusted'] = np.where(not_started, df['late_start_date'].values, late_end - target_end + target_start)
+    df['late_end_date_adjusted'] = late_end
     
     return df
 
@@ -231,92 +940,167 @@ def polarize_update_schedule(df, data_date, early_start_field_name, early_finish
                             , actual_start_field_name, actual_finish_field_name):
     '''Divides an update schedule to update Actualized with actual dates and update planned with early and late dates'''
     
+    # Classifying status once
+    status = df['status_code'].values
+    not_started = status == 'TK_NotStart'
+    completed = status == 'TK_Complete'
+    
     # Filtering for Actualized Activities
-    df_update_actual = df[df['status_code'] != 'TK_NotStart'].copy()
+    df_update_actual = df[~not_started].copy()
     
     # Letting Actual Starts remain
-    df_update_actual.loc[:, 'act_start_date_adjusted'] = pd.to_datetime(df_update_actual.loc[:, actual_start_field_name])
-    
-    # Setting data date as actual finish date for in-progress activities
-    if df_update_actual.loc[df_update_actual['status_code'] == 'TK_Active'].shape[0] !=0:
-        df_update_actual.loc[df_update_actual['status_code'] == 'TK_Active', 'act_end_date_adjusted'] = data_date
+    df_update_actual['act_start_date_adjusted'] = pd.to_datetime(df_update_actual[actual_start_field_name])
     
-    # Setting actual finish date as actual finish date for completed activities
-    if df_update_actual.loc[df_update_actual['status_code'] == 'TK_Complete'].shape[0] !=0:
-        df_update_actual.loc[df_update_actual['status_code'] == 'TK_Complete', 'act_end_date_adjusted'] = pd.to_datetime(df_update_actual.loc[df_update_actual['status_code'] == 'TK_Complete', actual_finish_field_name])
+    # Setting data date as actual finish date for in-progress activities and actual finish date for completed activities
+    act_end = pd.to_datetime(df_update_actual[actual_finish_field_name]).values
+    act_end = np.where(status[~not_started] == 'TK_Active', _to_datetime64(data_date), np.where(completed[~not_started], act_end, np.datetime64('NaT')))
+    df_update_actual['act_end_date_adjusted'] = act_end.astype('datetime64[ns]')
     
     # Filtering for Update Plan Activities
-    df_update_plan = df[df['status_code'] != 'TK_Complete'].copy()
+    df_update_plan = df[~completed].copy()
     
     # Letting Early and Late dates be Remaining Early and Late for In-Progress and non started activities
-    df_update_plan.loc[:, 'early_start_date_adjusted'] = pd.to_datetime(df_update_plan.loc[:, early_start_field_name])
-    df_update_plan.loc[:, 'early_end_date_adjusted'] = pd.to_datetime(df_update_plan.loc[:, early_finish_field_name])
-    df_update_plan.loc[:, 'late_start_date_adjusted'] = pd.to_datetime(df_update_plan.loc[:, late_start_field_name])
-    df_update_plan.loc[:, 'late_end_date_adjusted'] = pd.to_datetime(df_update_plan.loc[:, late_finish_field_name])
+    df_update_plan['early_start_date_adjusted'] = pd.to_datetime(df_update_plan[early_start_field_name])
+    df_update_plan['early_end_date_adjusted'] = pd.to_datetime(df_update_plan[early_finish_field_name])
+    df_update_plan['late_start_date_adjusted'] = pd.to_datetime(df_update_plan[late_start_field_name])
+    df_update_plan['late_end_date_adjusted'] = pd.to_datetime(df_update_plan[late_finish_field_name])
     
     return df_update_plan, df_update_actual
 
 
+def time_phase_baseline(df_baseline_tasks, id_field_name, baseline_early_start_field_name, baseline_early_finish_field_name,
+                        baseline_late_start_field_name, baseline_late_finish_field_name, instrumentation=None, calendars=None):
+    '''
+    Calculates baseline durations and early and late time-phased baseline once so they can be shared by calculate_earned_duration calls against several updates.
+    Returns the converted baseline data frame and its early and late time-phased data frames.
+    Durations are measured in working time of each activity's calendar if calendars (a WorkingCalendars) is given.
+    '''
+    
+    # Converting date fields once (text or datetime64 input)
+    df_baseline = convert_date_fields(df_baseline_tasks, [baseline_early_start_field_name, baseline_early_finish_field_name,
+                                                          baseline_late_start_field_name, baseline_late_finish_field_name])
+    
+    # Calculating Baseline Duration (Early_Finish - Early_Start)
+    df_baseline['baseline_duration'] = _get_durations(df_baseline[baseline_early_start_field_name].values, df_baseline[baseline_early_finish_field_name].values,
+                                                      df_baseline[calendars.calendar_field_name].values if calendars is not None else None, calendars)
+    df_baseline_tasks['baseline_duration'] = df_baseline['baseline_duration'].values
+    
+    if instrumentation is None:
+        instrumentation = _NULL_INSTRUMENTATION
+    df_baseline_early_time_phased = _time_phase_pass(None, 'baseline_early', df_baseline.copy(), id_field_name, baseline_early_start_field_name, baseline_early_finish_field_name, instrumentation, calendars)
+    df_baseline_late_time_phased = _time_phase_pass(None, 'baseline_late', df_baseline.copy(), id_field_name, baseline_late_start_field_name, baseline_late_finish_field_name, instrumentation, calendars)
+    
+    return df_baseline, df_baseline_early_time_phased, df_baseline_late_time_phased
+
+def select_time_phased(df_time_phased, index, num_columns):
+    ''' Selects rows of a time-phased data frame by index and drops the period columns (after the first num_columns) left without values.'''
+    df = df_time_phased[df_time_phased.index.isin(index)]
+    lst_period_columns = df.columns[num_columns:]
+    lst_empty_columns = lst_period_columns[df[lst_period_columns].isnull().values.all(axis = 0)]
+    return df.drop(lst_empty_columns, axis = 1)
+
 def calculate_earned_duration(df_baseline_tasks, df_update_tasks,
                               id_field_name, baseline_early_start_field_name, baseline_early_finish_field_name,
                               baseline_late_start_field_name, baseline_late_finish_field_name,
                               update_early_start_field_name, update_early_finish_field_name,
                               update_late_start_field_name, update_late_finish_field_name,
                               update_actual_start_field_name, update_actual_finish_field_name,
-                              fix_zero_actual_duration_flag, update_data_date):
-
-    num_baseline_columns = len(df_baseline_tasks.columns)
-    num_update_columns = len(df_update_tasks.columns)
+                              fix_zero_actual_duration_flag, update_data_date, baseline_time_phased=None, incremental_state=None, instrumentation=None, calendars=None):
+    '''
+    Calculates time-phased baseline, update, added, removed and earned durations of an update schedule against a baseline schedule.
+    baseline_time_phased may be the result of time_phase_baseline for df_baseline_tasks, to reuse baseline work across updates.
+    incremental_state may be a dictionary passed with consecutive updates (empty for the first one); update activities are then only re-phased if their dates changed since the previous update.
+    instrumentation may be an Instrumentation collecting stage metrics and data-quality issues.
+    calendars may be a WorkingCalendars to measure durations in working days of each activity's calendar instead of elapsed days.
+    '''
+    if instrumentation is None:
+        instrumentation = _NULL_INSTRUMENTATION
     
-    # Calculating Baseline Duration (Early_Finish - Early_Start)
-    df_baseline_tasks['baseline_duration'] = pd.to_datetime(df_baseline_tasks[baseline_early_finish_field_name]) - pd.to_datetime(df_baseline_tasks[baseline_early_start_field_name])
+    if baseline_time_phased is None:
+        baseline_time_phased = time_phase_baseline(df_baseline_tasks, id_field_name, baseline_early_start_field_name, baseline_early_finish_field_name,
+                                                   baseline_late_start_field_name, baseline_late_finish_field_name, instrumentation, calendars)
+    df_baseline, df_baseline_early_time_phased, df_baseline_late_time_phased = baseline_time_phased
+    num_baseline_columns = len(df_baseline.columns)
+    
+    # Converting date fields once (text or datetime64 input)
+    df_update = convert_date_fields(df_update_tasks, [update_early_start_field_name, update_early_finish_field_name,
+                                                      update_late_start_field_name, update_late_finish_field_name,
+                                                      update_actual_start_field_name, update_actual_finish_field_name])
     
     # TODO: Fixing update activities with actual dates in the future
     #df_update_tasks.ix[df_update_tasks['act_start_date'] > update_data_date, '']
     
-    # Finding Added/Removed Activities
-    df_removed = df_baseline_tasks[~(df_baseline_tasks[id_field_name].isin(df_update_tasks[id_field_name]))]
-    df_added = df_update_tasks[~(df_update_tasks[id_field_name].isin(df_baseline_tasks[id_field_name]))]
+    with instrumentation.stage('match_diff', len(df_baseline) + len(df_update)) as record:
+        # Finding Added/Removed Activities
+        in_update = df_baseline[id_field_name].isin(df_update[id_field_name]).values
+        in_baseline = df_update[id_field_name].isin(df_baseline[id_field_name]).values
+        df_removed = df_baseline[~in_update]
+        df_added = df_update[~in_baseline]
+        
+        # Finding matched activities
+        df_baseline_matched = df_baseline[in_update]
+        df_update_matched = df_update[in_baseline]
     
-    # Finding matched activities
-    df_baseline_matched = df_baseline_tasks[df_baseline_tasks[id_field_name].isin(df_update_tasks[id_field_name])]
-    df_update_matched = df_update_tasks[df_update_tasks[id_field_name].isin(df_baseline_tasks[id_field_name])]
-
-    # Adding baseline_duration to update_matched
-    df_update_matched = df_update_matched.merge(df_baseline_matched[[id_field_name, 'baseline_duration']], left_on= id_field_name, right_on = id_field_name, how = 'inner') 
+        # Adding baseline_duration to update_matched
+        df_update_matched = df_update_matched.merge(df_baseline_matched[[id_field_name, 'baseline_duration']], left_on= id_field_name, right_on = id_field_name, how = 'inner') 
+        record['rows_out'] = len(df_update_matched)
+    
+    if df_removed.shape[0] == 0:
+        instrumentation.add_issue('match_diff', 'no_removed_activities')
+    if df_added.shape[0] == 0:
+        instrumentation.add_issue('match_diff', 'no_added_activities')
+    
+    # Classifying actual status once
+    actual_start = df_update_matched[update_actual_start_field_name].values
+    actual_finish = df_update_matched[update_actual_finish_field_name].values
+    baseline_duration = df_update_matched['baseline_duration'].values
+    has_actual_start = ~pd.isnull(actual_start)
+    has_actual_finish = ~pd.isnull(actual_finish)
+    completed = has_actual_start & has_actual_finish
+    in_progress = has_actual_start & ~has_actual_finish
+    not_started = ~has_actual_start & ~has_actual_finish
     
     # Fixing activities with 0 At Completion Duration
     if (fix_zero_actual_duration_flag == True):
         # Completed Activities
-        for i, row in df_update_matched.loc[(df_update_matched[update_actual_start_field_name] != '') & (df_update_matched[update_actual_finish_field_name] != ''), :].iterrows():
-            if parser.parse(row[update_actual_finish_field_name]) == parser.parse(row[update_actual_start_field_name]):
-                df_update_matched.loc[i, update_actual_start_field_name] = parser.parse(df_update_matched.loc[i, update_actual_finish_field_name]) - df_update_matched.loc[i, 'baseline_duration']
+        zero_duration = completed & (actual_start == actual_finish)
+        if calendars is None:
+            actual_start = np.where(zero_duration, actual_finish - baseline_duration, actual_start)
+        else:
+            # baseline_duration is in working days: walking the calendar back from the actual finish
+            actual_start = actual_start.copy()
+            actual_start[zero_duration] = calendars.subtract_working_days(df_update_matched[calendars.calendar_field_name].values[zero_duration],
+                                                                          actual_finish[zero_duration], baseline_duration[zero_duration] / np.timedelta64(1, 'D'))
+        df_update_matched[update_actual_start_field_name] = actual_start
                 
     # Calculating At-Completion Duration for update_matched
     #   Completed Activities (Actual_Finish - Actual_Start)
-    df_update_matched.loc[(df_update_matched[update_actual_start_field_name] != '') & (df_update_matched[update_actual_finish_field_name] != ''), 'at_completion_duration'] = pd.to_datetime(df_update_matched.loc[(df_update_matched[update_actual_start_field_name] != '') & (df_update_matched[update_actual_finish_field_name] != ''), update_actual_finish_field_name]) - pd.to_datetime(df_update_matched.loc[(df_update_matched[update_actual_start_field_name] != '') & (df_update_matched[update_actual_finish_field_name] != ''), update_actual_start_field_name])
     #   In-Progress Activities (Early_Finish - Actual_Start)
-    df_update_matched.loc[(df_update_matched[update_actual_start_field_name] != '') & (df_update_matched[update_actual_finish_field_name] == ''), 'at_completion_duration'] = pd.to_datetime(df_update_matched.loc[(df_update_matched[update_actual_start_field_name] != '') & (df_update_matched[update_actual_finish_field_name] == ''), update_early_finish_field_name]) - pd.to_datetime(df_update_matched.loc[(df_update_matched[update_actual_start_field_name] != '') & (df_update_matched[update_actual_finish_field_name] == ''), update_actual_start_field_name]) 
     #   Not-Started Activities (Early_Finish - Early_Start)
-    df_update_matched.loc[(df_update_matched[update_actual_start_field_name] == '') & (df_update_matched[update_actual_finish_field_name] == ''), 'at_completion_duration'] = pd.to_datetime(df_update_matched.loc[(df_update_matched[update_actual_start_field_name] == '') & (df_update_matched[update_actual_finish_field_name] == ''), update_early_finish_field_name]) - pd.to_datetime(df_update_matched.loc[(df_update_matched[update_actual_start_field_name] == '') & (df_update_matched[update_actual_finish_field_name] == ''), update_early_start_field_name])
+    early_start = df_update_matched[update_early_start_field_name].values
+    early_finish = df_update_matched[update_early_finish_field_name].values
+    df_update_matched['at_completion_duration'] = _get_durations(np.where(has_actual_start, actual_start, np.where(not_started, early_start, np.datetime64('NaT'))).astype('datetime64[ns]'),
+                                                                 np.where(completed, actual_finish, np.where(in_progress | not_started, early_finish, np.datetime64('NaT'))).astype('datetime64[ns]'),
+                                                                 df_update_matched[calendars.calendar_field_name].values if calendars is not None else None, calendars)
+    if instrumentation.enabled and (has_actual_finish & ~has_actual_start).any():
+        instrumentation.add_issue('at_completion_duration', 'actual_finish_without_actual_start', df_update_matched[id_field_name].values[has_actual_finish & ~has_actual_start])
     
     # Polarizing Update File
     df_update_matched_plan, df_update_matched_actual = polarize_update_schedule(df_update_matched, update_data_date, update_early_start_field_name, update_early_finish_field_name, update_late_start_field_name, update_late_finish_field_name, update_actual_start_field_name, update_actual_finish_field_name)
     
     # Time Phasing Matched
-    #    Calculating Baseline Time-Phased
-    df_baseline_matched_early_time_phased = time_phase_monthly(df_baseline_matched, id_field_name, baseline_early_start_field_name, baseline_early_finish_field_name)
-    df_baseline_matched_late_time_phased = time_phase_monthly(df_baseline_matched, id_field_name, baseline_late_start_field_name, baseline_late_finish_field_name)
+    #    Selecting Baseline Time-Phased
+    df_baseline_matched_early_time_phased = select_time_phased(df_baseline_early_time_phased, df_baseline_matched.index, num_baseline_columns)
+    df_baseline_matched_late_time_phased = select_time_phased(df_baseline_late_time_phased, df_baseline_matched.index, num_baseline_columns)
     #    Calculating Update Time-Phased
-    df_update_matched_actual_time_phased = time_phase_monthly(df_update_matched_actual, id_field_name, 'act_start_date_adjusted', 'act_end_date_adjusted')
-    df_update_matched_plan_early_time_phased = time_phase_monthly(df_update_matched_plan, id_field_name, 'early_start_date_adjusted', 'early_end_date_adjusted')
-    df_update_matched_plan_late_time_phased = time_phase_monthly(df_update_matched_plan, id_field_name, 'late_start_date_adjusted', 'late_end_date_adjusted')
+    df_update_matched_actual_time_phased = _time_phase_pass(incremental_state, 'update_matched_actual', df_update_matched_actual, id_field_name, 'act_start_date_adjusted', 'act_end_date_adjusted', instrumentation, calendars)
+    df_update_matched_plan_early_time_phased = _time_phase_pass(incremental_state, 'update_matched_plan_early', df_update_matched_plan, id_field_name, 'early_start_date_adjusted', 'early_end_date_adjusted', instrumentation, calendars)
+    df_update_matched_plan_late_time_phased = _time_phase_pass(incremental_state, 'update_matched_plan_late', df_update_matched_plan, id_field_name, 'late_start_date_adjusted', 'late_end_date_adjusted', instrumentation, calendars)
     
     # Time Phasing Removed
     if df_removed.shape[0] !=0:
-        df_removed_time_phased = time_phase_monthly(df_removed, id_field_name, baseline_early_start_field_name, baseline_early_finish_field_name)
+        df_removed_time_phased = select_time_phased(df_baseline_early_time_phased, df_removed.index, num_baseline_columns)
     else:
-        print 'There are no removed activities.'
         df_removed_time_phased = None
     
     # Time Phasing Added
@@ -327,20 +1111,214 @@ def calculate_earned_duration(df_baseline_tasks, df_update_tasks,
         df_added_actual_time_phased = pd.DataFrame()
 
         if df_added_plan.shape[0] !=0:
-            df_added_plan_time_phased = time_phase_monthly(df_added_plan, id_field_name, 'early_start_date_adjusted', 'early_end_date_adjusted' )
+            df_added_plan_time_phased = _time_phase_pass(incremental_state, 'added_plan', df_added_plan, id_field_name, 'early_start_date_adjusted', 'early_end_date_adjusted', instrumentation, calendars)
         if df_added_actual.shape[0] !=0:
-            df_added_actual_time_phased = time_phase_monthly(df_added_actual, id_field_name, 'act_start_date_adjusted', 'act_end_date_adjusted' )
+            df_added_actual_time_phased = _time_phase_pass(incremental_state, 'added_actual', df_added_actual, id_field_name, 'act_start_date_adjusted', 'act_end_date_adjusted', instrumentation, calendars)
 
     else:
-        print 'There are no added activities.'
         df_added_plan_time_phased = None
         df_added_actual_time_phased = None
     
     # Calculate earned duration for matched Actual
-    df_earned_matched_time_phased = df_update_matched_actual_time_phased.copy() 
-    df_earned_matched_time_phased = df_earned_matched_time_phased[(df_earned_matched_time_phased['baseline_duration'] != datetime.timedelta(0.0)) & (df_earned_matched_time_phased['at_completion_duration'] != datetime.timedelta(0.0))]
-    #df_earned_matched_time_phased.ix[:,61+4:] = df_earned_matched_time_phased.ix[:,61+4:].mul(df_earned_matched_time_phased.apply(lambda row: row['baseline_duration'] / row['at_completion_duration'], axis =1), axis = 0)
-    print num_baseline_columns, num_update_columns
-    df_earned_matched_time_phased.ix[:,num_update_columns + 4:] = df_earned_matched_time_phased.ix[:,num_update_columns+4:].mul(df_earned_matched_time_phased.apply(lambda row: row['baseline_duration'] / row['at_completion_duration'], axis =1), axis = 0)
+    with instrumentation.stage('earned_ratio', len(df_update_matched_actual_time_phased)) as record:
+        df_earned_matched_time_phased = df_update_matched_actual_time_phased.copy() 
+        df_earned_matched_time_phased = df_earned_matched_time_phased[(df_earned_matched_time_phased['baseline_duration'] != datetime.timedelta(0.0)) & (df_earned_matched_time_phased['at_completion_duration'] != datetime.timedelta(0.0))]
+        earned_ratio = df_earned_matched_time_phased['baseline_duration'].values / df_earned_matched_time_phased['at_completion_duration'].values
+        lst_period_columns = df_update_matched_actual_time_phased.columns[len(df_update_matched_actual.columns):]
+        df_earned_matched_time_phased[lst_period_columns] = df_earned_matched_time_phased[lst_period_columns].values * earned_ratio[:, np.newaxis]
+        record['rows_out'] = len(df_earned_matched_time_phased)
+    
     return df_baseline_matched_early_time_phased, df_baseline_matched_late_time_phased, df_update_matched_actual_time_phased, df_update_matched_plan_early_time_phased, df_update_matched_plan_late_time_phased, df_removed_time_phased, df_added_plan_time_phased, df_added_actual_time_phased, df_earned_matched_time_phased
-	
\ No newline at end of file
+
+def get_edm_measures(edm_results):
+    '''
+    Groups the outputs of calculate_earned_duration into the time-phased data frames of each Earned Duration curve:
+    planned_early (baseline early of matched and removed activities), planned_late (baseline late of matched activities),
+    actual (actual of matched and added activities) and earned (earned of matched activities).
+    '''
+    (df_baseline_matched_early_time_phased, df_baseline_matched_late_time_phased, df_update_matched_actual_time_phased,
+     df_update_matched_plan_early_time_phased, df_update_matched_plan_late_time_phased, df_removed_time_phased,
+     df_added_plan_time_phased, df_added_actual_time_phased, df_earned_matched_time_phased) = edm_results
+    return {'planned_early': [df_baseline_matched_early_time_phased, df_removed_time_phased],
+            'planned_late': [df_baseline_matched_late_time_phased],
+            'actual': [df_update_matched_actual_time_phased, df_added_actual_time_phased],
+            'earned': [df_earned_matched_time_phased]}
+
+def _time_phased_to_long(time_phased, id_field_name):
+    ''' Converts a wide time-phased data frame (monthly YYYY-MM columns) or a TimePhased into (id, interval, duration) rows.'''
+    if isinstance(time_phased, TimePhased):
+        return time_phased.to_long()
+    lst_period_columns = [x for x in time_phased.columns if re.match(r'^\d{4}-\d{2}$', str(x))]
+    sr = time_phased.set_index(id_field_name)[lst_period_columns].stack()
+    sr.index.names = [id_field_name, 'interval']
+    return sr.reset_index(name = 'duration')
+
+class RollupCube(object):
+    '''
+    Monthly Earned Duration curves aggregated per hierarchy node (e.g. CSI activity code or WBS path) with cumulative sums along time.
+    
+    Nodes are every prefix of the dotted task paths; the '' node is the whole project. curves and cumulative map each measure to a data frame of periods x nodes.
+    Any node and date range query is then a lookup instead of a regroup of the time-phased data frames.
+    '''
+    
+    def __init__(self, dict_time_phased, df_task_paths, id_field_name='task_id', path_field_name='path'):
+        # Mapping every task to all nodes above it
+        df_task_paths = df_task_paths[[id_field_name, path_field_name]].dropna().drop_duplicates(id_field_name)
+        lst_paths = df_task_paths[path_field_name].unique()
+        df_path_nodes = pd.DataFrame([(path, '.'.join(path.split('.')[:i + 1])) for path in lst_paths for i in range(len(path.split('.')))],
+                                     columns = [path_field_name, 'node'])
+        df_task_nodes = df_task_paths.merge(df_path_nodes, on = path_field_name)[[id_field_name, 'node']]
+        
+        # Aggregating durations per period and node
+        dict_curves = {}
+        for measure, lst_time_phased in dict_time_phased.items():
+            lst_long = [_time_phased_to_long(x, id_field_name) for x in lst_time_phased if x is not None and len(x) > 0]
+            if not lst_long:
+                continue
+            df_long = pd.concat(lst_long, ignore_index = True)
+            df_curves = df_long.merge(df_task_nodes, on = id_field_name).groupby(['interval', 'node'])['duration'].sum().unstack('node')
+            df_curves[''] = df_long.groupby('interval')['duration'].sum()
+            dict_curves[measure] = df_curves
+        
+        # Aligning all measures and nodes on one gap-free monthly range
+        lst_nodes = sorted(set(df_path_nodes['node']) | set(['']))
+        lst_intervals = sorted(set().union(*[x.index for x in dict_curves.values()]))
+        self.curves = {}
+        self.cumulative = {}
+        for measure, df_curves in dict_curves.items():
+            df_curves = fill_date_range_gaps(df_curves.reindex(index = lst_intervals, columns = lst_nodes)).fillna(0.0)
+            self.curves[measure] = df_curves
+            self.cumulative[measure] = df_curves.cumsum()
+        self.periods = df_curves.index if dict_curves else pd.PeriodIndex([], freq = 'M')
+        self.nodes = lst_nodes
+        self.cost_curves = {}
+        self.cost_cumulative = {}
+    
+    def set_schedule_of_values(self, sr_sov, baseline_measure='planned_early'):
+        '''
+        Cost loads every measure from a Schedule of Values (node path -> value) given on non-overlapping nodes.
+        Each SOV node's value is spread over its baseline_measure total duration, so a day of any measure under that node is worth value / total duration.
+        '''
+        df_baseline_total = self.cumulative[baseline_measure].iloc[-1]
+        for measure in self.curves:
+            df_curves = self.curves[measure]
+            df_cost_curves = pd.DataFrame(0.0, index = df_curves.index, columns = df_curves.columns)
+            for sov_node, value in sr_sov.items():
+                if sov_node not in df_curves.columns or df_baseline_total[sov_node] == 0:
+                    continue
+                rate = value / df_baseline_total[sov_node]
+                
+                # Nodes containing the SOV node receive its whole cost-loaded curve, nodes under it their own curve at its rate
+                lst_ancestors = [x for x in df_curves.columns if x == '' or sov_node == x or sov_node.startswith(x + '.')]
+                lst_descendants = [x for x in df_curves.columns if x.startswith(sov_node + '.')]
+                df_cost_curves[lst_ancestors] = df_cost_curves[lst_ancestors].add(df_curves[sov_node] * rate, axis = 0)
+                df_cost_curves[lst_descendants] = df_cost_curves[lst_descendants] + df_curves[lst_descendants] * rate
+            self.cost_curves[measure] = df_cost_curves
+            self.cost_cumulative[measure] = df_cost_curves.cumsum()
+    
+    def _get_range(self, start, end):
+        ''' Returns the positions of the first period from start and after the last period up to end, clipped to the periods of the curves.'''
+        i = 0 if start is None else self.periods.searchsorted(pd.Period(start, freq = 'M'))
+        j = len(self.periods) if end is None else self.periods.searchsorted(pd.Period(end, freq = 'M'), side = 'right')
+        return int(i), max(int(j), int(i))
+    
+    def get_curve(self, measure, node='', start=None, end=None, cumulative=False, cost_loaded=False):
+        ''' Returns the monthly (or cumulative) curve of a measure for a node between start and end periods (YYYY-MM, inclusive, clipped to the curves).'''
+        if cost_loaded:
+            df = self.cost_cumulative[measure] if cumulative else self.cost_curves[measure]
+        else:
+            df = self.cumulative[measure] if cumulative else self.curves[measure]
+        i, j = self._get_range(start, end)
+        return df[node].iloc[i:j]
+    
+    def get_total(self, measure, node='', start=None, end=None, cost_loaded=False):
+        ''' Returns the total of a measure for a node between start and end periods (YYYY-MM, inclusive) from the cumulative sums.'''
+        sr = (self.cost_cumulative if cost_loaded else self.cumulative)[measure][node].values
+        i, j = self._get_range(start, end)
+        if i == j:
+            # No period of the curves in the range
+            return 0.0
+        return sr[j - 1] - (sr[i - 1] if i > 0 else 0.0)
+
+# Baseline work and options shared with batch worker processes
+_batch_state = {}
+
+def _init_batch_worker(dict_state):
+    ''' Stores the shared baseline work in a batch worker process.'''
+    _batch_state.update(dict_state)
+
+def _calculate_earned_duration_for_update(update_file_name):
+    ''' Reads, filters and calculates earned duration of one update XER file against the shared baseline.'''
+    s = _batch_state
+    df_xer, data_date = read_xer(update_file_name, tables = ['PROJWBS', 'TASK'])
+    if s['lst_wbs_inclusions'] is None:
+        df_update_tasks = df_xer['TASK']
+    else:
+        df_update_tasks = get_tasks_by_wbs_paths(s['lst_wbs_inclusions'], s['lst_wbs_exclusions'], df_xer)
+    
+    data_date = _to_datetime64(data_date)
+    return data_date, calculate_earned_duration(s['df_baseline_tasks'], df_update_tasks, *(s['lst_field_names'] + [s['fix_zero_actual_duration_flag'], data_date]),
+                                                baseline_time_phased = s['baseline_time_phased'])
+
+def calculate_earned_duration_batch(baseline_file_name, lst_update_file_names, lst_wbs_inclusions, lst_wbs_exclusions,
+                                    id_field_name, baseline_early_start_field_name, baseline_early_finish_field_name,
+                                    baseline_late_start_field_name, baseline_late_finish_field_name,
+                                    update_early_start_field_name, update_early_finish_field_name,
+                                    update_late_start_field_name, update_late_finish_field_name,
+                                    update_actual_start_field_name, update_actual_finish_field_name,
+                                    fix_zero_actual_duration_flag, num_workers=None):
+    '''
+    Calculates earned duration of a baseline XER file against an ordered list of update XER files.
+    Baseline WBS filtering and time-phasing are done once and updates are processed in a pool of num_workers processes (all cores if None, in-process if 1).
+    WBS filtering is skipped if lst_wbs_inclusions is None.
+    Returns the outputs of calculate_earned_duration stacked with the data date (last_recalc_date) and the position in lst_update_file_names of each update
+    as the outer index levels (data_date, update), so updates sharing a data date (e.g. a reissued update) are kept apart.
+    '''
+    import multiprocessing
+    
+    # Reading and filtering baseline once
+    df_xer, baseline_data_date = read_xer(baseline_file_name, tables = ['PROJWBS', 'TASK'])
+    if lst_wbs_inclusions is None:
+        df_baseline_tasks = df_xer['TASK']
+    else:
+        df_baseline_tasks = get_tasks_by_wbs_paths(lst_wbs_inclusions, lst_wbs_exclusions, df_xer)
+    df_baseline_tasks = df_baseline_tasks.copy()
+    del df_xer
+    
+    # Time-phasing baseline once
+    baseline_time_phased = time_phase_baseline(df_baseline_tasks, id_field_name, baseline_early_start_field_name, baseline_early_finish_field_name,
+                                               baseline_late_start_field_name, baseline_late_finish_field_name)
+    
+    dict_state = {'df_baseline_tasks': df_baseline_tasks,
+                  'baseline_time_phased': baseline_time_phased,
+                  'lst_wbs_inclusions': lst_wbs_inclusions,
+                  'lst_wbs_exclusions': lst_wbs_exclusions,
+                  'fix_zero_actual_duration_flag': fix_zero_actual_duration_flag,
+                  'lst_field_names': [id_field_name, baseline_early_start_field_name, baseline_early_finish_field_name,
+                                      baseline_late_start_field_name, baseline_late_finish_field_name,
+                                      update_early_start_field_name, update_early_finish_field_name,
+                                      update_late_start_field_name, update_late_finish_field_name,
+                                      update_actual_start_field_name, update_actual_finish_field_name]}
+    
+    # Processing updates
+    if num_workers == 1:
+        _init_batch_worker(dict_state)
+        lst_results = [_calculate_earned_duration_for_update(x) for x in lst_update_file_names]
+    else:
+        pool = multiprocessing.Pool(num_workers, initializer = _init_batch_worker, initargs = (dict_state,))
+        try:
+            lst_results = pool.map(_calculate_earned_duration_for_update, lst_update_file_names, chunksize = 1)
+        finally:
+            pool.close()
+            pool.join()
+    
+    # Stacking each output by data date and update position
+    lst_stacked = []
+    for i in range(len(lst_results[0][1]) if lst_results else 0):
+        lst_frames = [((data_date, j), result[i]) for j, (data_date, result) in enumerate(lst_results) if result[i] is not None]
+        if lst_frames:
+            lst_stacked.append(pd.concat([x[1] for x in lst_frames], keys = [x[0] for x in lst_frames], names = ['data_date', 'update'], sort = False))
+        else:
+            lst_stacked.append(None)
+    
+    return tuple(lst_stacked)